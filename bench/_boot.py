@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""تهيئة مشتركة لسكربتات القياس: بيئة وهمية آمنة ثم استيراد bot.py من جذر المستودع."""
+import os, sys, tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+_TMP = Path(tempfile.mkdtemp(prefix="bot-bench-"))
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+os.environ.setdefault("SERVE_HEALTH", "0")
+os.environ.setdefault("DB_PATH", str(_TMP / "bench.db"))
+os.environ.setdefault("TMP_DIR", str(_TMP))
+os.environ.setdefault("RENDER", "1")  # لا تحمّل .env المحلي أثناء القياس
+
+sys.path.insert(0, str(ROOT))
+import bot  # noqa: E402
+
+def pct(samples, p):
+    if not samples: return 0.0
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+def summary(name, samples, unit="ms", scale=1000.0):
+    return (f"{name:<28} n={len(samples):<6} p50={pct(samples,50)*scale:8.2f}{unit} "
+            f"p95={pct(samples,95)*scale:8.2f}{unit} p99={pct(samples,99)*scale:8.2f}{unit}")
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""جلسة ai_chat طويلة ضد المحاكي المحلي: حجم الـ prompt لكل دور ونسبة كاش البادئة والطيّات.
+
+    python bench/bench_chat.py [--turns 60] [--chars 200] [--budget 1500]
+
+يقارن ثلاثة أوضاع: stateless (السلوك القديم: system + الرسالة فقط)، و full (كل السجل بلا سقف، ما يفعله
+المستخدم حين يعيد لصق السياق)، و budgeted (ai_state + الملخص + AI_CHAT_HISTORY_TOKENS).
+"""
+import argparse, asyncio, os, time
+from fake_upstreams import UpstreamSim
+
+sim = UpstreamSim()
+os.environ.update(sim.reserve())
+os.environ.setdefault("AI_STREAM_EDIT_INTERVAL", "100")
+from _boot import bot, pct
+
+class FakeMessage:
+    async def reply_text(self, *a, **k): return self
+    async def edit_text(self, *a, **k): pass
+
+def _tokens():
+    return {lv[0]: v for lv, v in bot.M_AI_TOKENS._v.items()}
+
+async def session(name, turns, chars, budget, uid):
+    bot.AI_CHAT_HISTORY_TOKENS = budget
+    await bot.ai_set_mode_async(uid, "ai_chat")
+    sizes, lat, before = [], [], _tokens()
+    for i in range(turns):
+        text = f"turn {i}: " + "x" * chars
+        _, chat = await bot.ai_get_mode_async(uid)
+        chat = None if budget == 0 else chat
+        sizes.append(sum(bot.tok_est(m["content"]) for m in bot.ai_request("ai_chat", text, chat)[0]))
+        t = time.perf_counter()
+        reply = await bot.ai_reply_streaming(FakeMessage(), "ai_chat", text, chat=chat)
+        lat.append(time.perf_counter() - t)
+        if budget: await bot.chat_record(uid, text, reply)
+        await asyncio.sleep(0)
+    while bot._chat_folding: await asyncio.sleep(0.01)
+    after = _tokens()
+    prompt = after.get("prompt", 0) - before.get("prompt", 0)
+    cached = after.get("cached", 0) - before.get("cached", 0)
+    print(f"{name:<10} prompt/turn p50={pct(sizes, 50):6.0f} max={max(sizes):6.0f}  provider prompt={prompt:7d} "
+          f"cached={cached / prompt if prompt else 0:5.1%}  reply p50={pct(lat, 50) * 1000:6.1f}ms")
+
+async def main(turns, chars, budget):
+    await sim.start(); sim.configure(None, latency=("fixed", 0.005), token_delay=0)
+    bot.init_db()
+    await bot._adb.start()
+    await session("stateless", turns, chars, 0, 1)
+    await session("full", turns, chars, 10**9, 2)
+    await session("budgeted", turns, chars, budget, 3)
+    print(" ".join(f"folds_{lv[0]}={v}" for lv, v in bot.M_AI_FOLDS._v.items()) or "folds=0")
+    await bot._http.close(); await bot._adb.close(); await sim.close()
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--turns", type=int, default=60)
+    ap.add_argument("--chars", type=int, default=200)
+    ap.add_argument("--budget", type=int, default=bot.AI_CHAT_HISTORY_TOKENS)
+    a = ap.parse_args()
+    asyncio.run(main(a.turns, a.chars, a.budget))
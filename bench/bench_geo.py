@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""قياس فهرس الموقع المحلي GeoIndex: زمن التحميل، عمليات البحث/ثانية، وحجم الفهرس في الذاكرة.
+
+    python bench/bench_geo.py [--ranges 300000] [--lookups 500000] [--csv path.csv]
+
+بدون --csv يُولَّد ملف CSV صناعي بنطاقات IPv4 متتالية.
+"""
+import argparse, csv, os, random, time, tracemalloc
+from _boot import bot, _TMP
+
+def make_csv(path, n):
+    countries = ["SA", "AE", "EG", "US", "DE", "FR", "GB", "IN", "TR", "JP"]
+    step = (2**32 - 2**24) // n
+    with open(path, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["start", "end", "country", "regionName", "city", "lat", "lon", "timezone", "isp", "as"])
+        for i in range(n):
+            lo = 2**24 + i * step
+            c = countries[i % len(countries)]
+            w.writerow([lo, lo + step - 1, c, f"R{i % 50}", f"City{i % 500}", 24.7, 46.7, "UTC", f"ISP{i % 200}", f"AS{i % 200}"])
+
+def main(ranges, lookups, path):
+    if not path:
+        path = os.path.join(_TMP, "geo.csv"); make_csv(path, ranges)
+    t = time.perf_counter()
+    idx = bot.GeoIndex.load_csv(path)
+    load_s = time.perf_counter() - t
+    tracemalloc.start()  # تحميل ثانٍ للقياس فقط (tracemalloc يبطّئ التحميل كثيراً)
+    idx = bot.GeoIndex.load_csv(path)
+    cur, peak = tracemalloc.get_traced_memory(); tracemalloc.stop()
+    queries = [str(bot.ipaddress.IPv4Address(random.randrange(2**24, 2**32))) for _ in range(lookups)]
+    t = time.perf_counter(); hits = sum(1 for q in queries if idx.lookup(q) is not None); dt = time.perf_counter() - t
+    print(f"ranges={len(idx)} records={len(idx.records)} load={load_s:.2f}s")
+    print(f"index resident={idx.nbytes()/2**20:.1f} MiB (traced after load={cur/2**20:.1f} MiB, peak during load={peak/2**20:.1f} MiB)")
+    print(f"lookups={lookups} hits={hits} rate={lookups/dt:,.0f}/s ({dt/lookups*1e6:.2f} µs/lookup)")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--ranges", type=int, default=300000)
+    ap.add_argument("--lookups", type=int, default=500000)
+    ap.add_argument("--csv", default="")
+    a = ap.parse_args()
+    main(a.ranges, a.lookups, a.csv)
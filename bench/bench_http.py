@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""يقارن جلسة aiohttp جديدة لكل طلب مع الجلسة المشتركة _http على طلبات متكررة.
+
+    python bench/bench_http.py [--n 300] [--host localhost]
+
+الخادم محلي، لذلك الفرق هنا = إنشاء connector + DNS + TCP handshake فقط؛
+مع TLS ومزوّد خارجي يكون الفرق أكبر بكثير.
+"""
+import argparse, asyncio, time
+import aiohttp
+from aiohttp import web
+from _boot import bot, summary
+
+async def _serve():
+    app = web.Application()
+    async def geo(request):
+        return web.json_response({"status": "success", "query": request.match_info["q"], "country": "SA"})
+    app.router.add_get("/json/{q}", geo)
+    runner = web.AppRunner(app); await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0); await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+async def main(n, host):
+    runner, port = await _serve()
+    url = f"http://{host}:{port}/json/1.1.1.1"
+    fresh, shared = [], []
+    for _ in range(n):
+        t = time.perf_counter()
+        async with aiohttp.ClientSession() as s:
+            async with s.get(url) as r: await r.json()
+        fresh.append(time.perf_counter() - t)
+    for _ in range(n):
+        t = time.perf_counter()
+        async with bot._http.session().get(url, timeout=bot._http.timeout("ipapi")) as r: await r.json()
+        shared.append(time.perf_counter() - t)
+    await bot._http.close(); await runner.cleanup()
+    print(summary("new session per request", fresh))
+    print(summary("shared pooled session", shared))
+    print(f"mean speedup: {sum(fresh)/max(sum(shared),1e-9):.1f}x")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=300)
+    ap.add_argument("--host", default="localhost")
+    a = ap.parse_args()
+    asyncio.run(main(a.n, a.host))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""حمل مختلط: دفعة كبيرة من رسائل فحص الإيميل (OSINT بطيء) مع نقرات قوائم متتابعة، عبر معالج تحديثات PTB.
+
+    python bench/bench_pools.py [--osint 1500] [--latency 1.0] [--clicks 300]
+
+السيناريوهان بنفس السقف العام UPDATES_MAX_INFLIGHT:
+shared: pools بلا حدود ولا طوابير — تحجز رسائل OSINT كل المقاعد العامة وتنتظر النقرات خلفها.
+pools: POOL_LIMITS و POOL_QUEUES الحقيقية؛ ما زاد عن limit + queue يُرد عليه "مشغول" فوراً ويحرّر مقعده،
+فتبقى مقاعد للقوائم وتثبت p99. busy = عدد رسائل OSINT المردودة.
+"""
+import argparse, asyncio, os, time
+from types import SimpleNamespace as NS
+os.environ.setdefault("RL_USER_OSINT", "0")      # القياس هنا للتزامن لا لحدود المعدل
+os.environ.setdefault("RL_UPSTREAM_IPAPI", "0")
+from telegram.ext import SimpleUpdateProcessor
+from _boot import bot, summary
+
+MENU = ["back_home", "sections", "sec_services", "sec_unban", "sec_courses", "myinfo"]
+
+class FakeQuery:
+    def __init__(self, uid, data):
+        self.from_user = NS(id=uid, full_name="Bench User")
+        self.data = data
+    async def answer(self, *a, **k): pass
+    async def edit_message_text(self, *a, **k): pass
+    async def edit_message_reply_markup(self, *a, **k): pass
+
+class FakeMessage:
+    def __init__(self, text): self.text = text
+    async def reply_text(self, *a, **k): pass
+
+async def scenario(name, pools, n_osint, n_clicks, uid):
+    bot.WORK_POOLS.clear(); bot.WORK_POOLS.update(pools)
+    proc = SimpleUpdateProcessor(bot.UPDATES_MAX_INFLIGHT)
+    ctx = NS(bot=None)
+    menu = []
+
+    async def click(i):
+        upd = NS(callback_query=FakeQuery(uid, MENU[i % len(MENU)]))
+        t = time.perf_counter()
+        await proc.process_update(upd, bot.on_button(upd, ctx))
+        menu.append(time.perf_counter() - t)
+
+    async def osint(i):
+        upd = NS(effective_user=NS(id=uid), effective_chat=NS(id=uid), message=FakeMessage(f"user{i}@example.com"))
+        await proc.process_update(upd, bot.guard_messages(upd, ctx))
+
+    t0 = time.perf_counter()
+    load = [asyncio.create_task(osint(i)) for i in range(n_osint)]
+    await asyncio.sleep(0.05)  # الدفعة وصلت قبل النقرات
+    clicks = []
+    for i in range(n_clicks):
+        clicks.append(asyncio.create_task(click(i))); await asyncio.sleep(0.005)
+    await asyncio.gather(*clicks)
+    peak = {n: p.peak_waiting for n, p in bot.WORK_POOLS.items()}
+    await asyncio.gather(*load)
+    busy = bot.WORK_POOLS["osint"].rejected
+    print(summary(f"{name}: menu", menu), f"osint_peak_queue={peak.get('osint', 0)} busy={busy} total={time.perf_counter()-t0:.1f}s")
+
+async def main(n_osint, latency, n_clicks):
+    bot.init_db()
+    await bot._adb.start()
+    uid = 777
+    await bot.user_get_async(uid); await bot.user_grant_async(uid)
+    await bot.ai_set_mode_async(uid, "email_check")
+
+    async def slow_osint(email):
+        await asyncio.sleep(latency); return "ok"
+    bot.osint_email = slow_osint
+
+    big = 10**6
+    await scenario("shared", {n: bot.WorkPool(n, big) for n in bot.POOL_LIMITS}, n_osint, n_clicks, uid)
+    await scenario("pools", {n: bot.WorkPool(n, lim, bot.POOL_QUEUES.get(n, 0)) for n, lim in bot.POOL_LIMITS.items()},
+                   n_osint, n_clicks, uid)
+    await bot._adb.close()
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--osint", type=int, default=1500)
+    ap.add_argument("--latency", type=float, default=1.0)
+    ap.add_argument("--clicks", type=int, default=300)
+    a = ap.parse_args()
+    asyncio.run(main(a.osint, a.latency, a.clicks))
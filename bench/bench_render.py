@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""قياس كلفة on_button (i18n + بناء الكيبورد + التوجيه) بدون شبكة: استعلام callback وهمي ومستخدم VIP مخزّن.
+
+    python bench/bench_render.py [--rounds 2000]
+
+وضعان على نفس الـ routes: rebuild (الطريقة القديمة: كيبورد يُبنى في كل نقرة، و T يبني قاموسي اللغتين
+ويستدعي format دائماً) و cached (الكتالوج المحمّل مرة واحدة والكيبوردات المخزنة بـ lru_cache).
+"""
+import argparse, asyncio, time
+from types import SimpleNamespace as NS
+from _boot import bot, summary
+
+ROUTES = ["back_home", "sections", "sec_ai", "sec_security", "sec_services", "sec_unban",
+          "unban_instagram", "sec_courses", "sec_darkgpt", "pick_lang", "myinfo", "serv_games"]
+
+class FakeQuery:
+    def __init__(self, uid, data):
+        self.from_user = NS(id=uid, full_name="Bench User")
+        self.data = data
+    async def answer(self, *a, **k): pass
+    async def edit_message_text(self, *a, **k): pass
+    async def edit_message_reply_markup(self, *a, **k): pass
+
+def legacy_T(key, lang=None, **kw):
+    """T القديمة: القاموسان يُبنيان في كل استدعاء و format دائماً."""
+    AR = {k: v for k, (v, _) in bot._CATALOG["ar"].items()}
+    EN = {k: v for k, (v, _) in bot._CATALOG["en"].items()}
+    s = (EN if lang == "en" else AR).get(key, key)
+    try: return s.format(**{k: bot._escape(str(v)) for k, v in kw.items()})
+    except Exception: return s
+
+def use_rebuild(on: bool, saved={}):
+    """يستبدل الكيبوردات المخزّنة بدوالها الأصلية (بناء في كل نقرة) و T بالنسخة القديمة، أو يعيدها."""
+    if on:
+        for name, fn in vars(bot).items():
+            if hasattr(fn, "cache_info") and hasattr(fn, "__wrapped__"): saved[name] = fn
+        saved["T"] = bot.T
+        for name, fn in saved.items(): setattr(bot, name, legacy_T if name == "T" else fn.__wrapped__)
+    else:
+        for name, fn in saved.items(): setattr(bot, name, fn)
+        saved.clear()
+
+async def run(rounds, uid, ctx):
+    per = {r: [] for r in ROUTES}
+    for _ in range(20):  # تسخين الكاشات
+        for r in ROUTES: await bot.on_button(NS(callback_query=FakeQuery(uid, r)), ctx)
+    for _ in range(rounds):
+        for r in ROUTES:
+            upd = NS(callback_query=FakeQuery(uid, r))
+            t = time.perf_counter(); await bot.on_button(upd, ctx); per[r].append(time.perf_counter() - t)
+    return per
+
+async def main(rounds):
+    bot.init_db()
+    await bot._adb.start()
+    uid = 777
+    await bot.user_get_async(uid); await bot.user_grant_async(uid)
+    ctx = NS(bot=None)
+    use_rebuild(True)
+    old = await run(rounds, uid, ctx)
+    use_rebuild(False)
+    new = await run(rounds, uid, ctx)
+    await bot._adb.close()
+    for r in ROUTES:
+        print(summary(f"{r} rebuild", old[r], unit="µs", scale=1e6)); print(summary(f"{r} cached", new[r], unit="µs", scale=1e6))
+    a_old = [x for v in old.values() for x in v]; a_new = [x for v in new.values() for x in v]
+    print(summary("ALL rebuild", a_old, unit="µs", scale=1e6), f"mean={sum(a_old)/len(a_old)*1e6:.1f}µs")
+    print(summary("ALL cached", a_new, unit="µs", scale=1e6), f"mean={sum(a_new)/len(a_new)*1e6:.1f}µs")
+    print(f"mean speedup: {sum(a_old)/max(sum(a_new), 1e-9):.1f}x")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=2000)
+    asyncio.run(main(ap.parse_args().rounds))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""إعادة تشغيل مزيج تحديثات اصطناعي عبر build_application() الحقيقي ضد Bot API وهمي محلي (لا شبكة خارجية).
+
+    python bench/bench_replay.py [--updates 5000] [--users 200] [--concurrency 32] [--seed 1]   # مقارنة مع baseline_replay.json
+    python bench/bench_replay.py --save                  # تحديث الـ baseline
+    python bench/bench_replay.py --transport http        # عبر httpx وخادم aiohttp محلي (TELEGRAM_API_BASE)
+
+المزيج: /start، نقرات قوائم، VIP (إنشاء دفع/حالة)، ورسائل أدوات (ترجمة، والـ AI معطّل هنا → رد فوري).
+حلقة مغلقة: concurrency عملاء يمرّرون التحديثات عبر app.process_update (نفس handlers وبوابات وpools التطبيق).
+الأرقام: throughput (تحديث/ث) و p50/p95/p99 لكل handler. الـ baseline محفوظ لوضع inproc فقط.
+"""
+import argparse, asyncio, json, os, platform, random, time
+from pathlib import Path
+for k in ("RL_USER_AI", "RL_USER_OSINT", "RL_UPSTREAM_OPENAI"):
+    os.environ.setdefault(k, "0")   # نقيس كلفة المعالجة لا حدود المعدل
+os.environ.setdefault("MAIN_CHANNELS", "benchchan")
+os.environ.setdefault("SLOW_UPDATE_MS", "0")
+from telegram import Update
+from _boot import bot, pct
+from fake_botapi import FakeBotAPI, BOT_USER
+
+BASELINE = Path(__file__).resolve().parent / "baseline_replay.json"
+MENU = ["back_home", "sections", "sec_services", "sec_courses", "myinfo", "sec_unban", "unban_telegram",
+        "serv_games", "sec_ai", "sec_security", "pick_lang"]
+MIX = [("start", 10), ("menu", 55), ("vip", 10), ("tool", 25)]
+
+def _user(uid): return {"id": uid, "is_bot": False, "first_name": f"U{uid}"}
+
+def _message(i, uid, text):
+    m = {"message_id": i, "date": 0, "chat": {"id": uid, "type": "private"}, "from": _user(uid), "text": text}
+    if text.startswith("/"): m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": i, "message": m}
+
+def _callback(i, uid, data):
+    msg = {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "from": BOT_USER, "text": "menu"}
+    return {"update_id": i, "callback_query": {"id": str(i), "from": _user(uid), "chat_instance": "bench", "data": data, "message": msg}}
+
+def synth(n, users, rng):
+    kinds = [k for k, w in MIX for _ in range(w)]
+    out = []
+    for i in range(1, n + 1):
+        uid = 10_000 + rng.randrange(users)
+        kind = rng.choice(kinds)
+        if kind == "start": out.append(_message(i, uid, "/start"))
+        elif kind == "menu": out.append(_callback(i, uid, rng.choice(MENU)))
+        elif kind == "vip": out.append(_callback(i, uid, "vip"))
+        else: out.append(_message(i, uid, rng.choice(["hello world", "مرحبا بالعالم", "translate this please"])))
+    return out
+
+def instrument(app, samples):
+    """يغلّف callbacks المجموعة 0 (المغلّفة أصلاً بـ timed_handler) لتسجيل كل عيّنة باسم الـ handler."""
+    for h in app.handlers[0]:
+        fn, name = h.callback, h.callback.__name__
+        async def rec(update, context, fn=fn, name=name):
+            t = time.perf_counter()
+            try: return await fn(update, context)
+            finally: samples.setdefault(name, []).append(time.perf_counter() - t)
+        rec.__name__ = name
+        h.callback = rec
+
+async def main(n, users, concurrency, seed, save, transport):
+    fake = FakeBotAPI()
+    if transport == "http":
+        await fake.start(); bot.TELEGRAM_API_BASE = fake.base
+    bot.init_db()
+    app = bot.build_application(fake.request() if transport == "inproc" else None)
+    samples = {}
+    instrument(app, samples)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+
+    rng = random.Random(seed)
+    for uid in range(10_000, 10_000 + users):          # ثلث المستخدمين VIP، والباقي يمر ببوابة العضوية (getChatMember)
+        await bot.user_get_async(uid)                   # الصف أولاً: user_grant_async يحدّث صفاً موجوداً فقط
+        if rng.random() < 0.3: await bot.user_grant_async(uid)
+        await bot.ai_set_mode_async(uid, "translate")
+    vip = await bot._adb.fetchone("SELECT COALESCE(SUM(premium), 0) AS n FROM users")
+    print(f"seeded users={users} vip={vip['n']}")
+    updates = [Update.de_json(u, app.bot) for u in synth(n, users, rng)]
+
+    it = iter(updates)
+    async def client():
+        for u in it: await app.process_update(u)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    wall = time.perf_counter() - t0
+
+    await app.stop(); await app.post_shutdown(app); await app.shutdown()
+    await fake.close()
+
+    result = {"updates": n, "users": users, "concurrency": concurrency, "seed": seed, "python": platform.python_version(),
+              "throughput_ups": round(n / wall, 1), "handlers": {}}
+    for name, v in sorted(samples.items()):
+        result["handlers"][name] = {"n": len(v), "p50_ms": round(pct(v, 50) * 1000, 3),
+                                    "p95_ms": round(pct(v, 95) * 1000, 3), "p99_ms": round(pct(v, 99) * 1000, 3)}
+    result["routes"] = {k: {"n": c, "avg_ms": round(tot / c * 1000, 3)} for k, (c, tot, _) in sorted(bot.router.stats.items())}
+    base = json.loads(BASELINE.read_text()) if BASELINE.exists() and transport == "inproc" else None
+
+    def delta(cur, old):
+        return f" ({(cur - old) / old * 100:+.0f}%)" if old else ""
+    print(f"throughput {result['throughput_ups']:.1f} upd/s over {wall:.2f}s"
+          + (delta(result["throughput_ups"], base["throughput_ups"]) if base else ""))
+    print(f"telegram calls: {dict(sorted(fake.calls.items()))}")
+    for name, r in result["handlers"].items():
+        old = (base or {}).get("handlers", {}).get(name, {})
+        print(f"{name:<16} n={r['n']:<6} " + " ".join(
+            f"{p}={r[p + '_ms']:7.2f}ms{delta(r[p + '_ms'], old.get(p + '_ms'))}" for p in ("p50", "p95", "p99")))
+    for name, r in result["routes"].items():
+        old = (base or {}).get("routes", {}).get(name, {})
+        print(f"  route {name:<16} n={r['n']:<6} avg={r['avg_ms']:7.2f}ms{delta(r['avg_ms'], old.get('avg_ms'))}")
+    if save and transport == "inproc":
+        BASELINE.write_text(json.dumps(result, indent=2, ensure_ascii=False) + "\n")
+        print(f"baseline saved -> {BASELINE.name}")
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--updates", type=int, default=5000)
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--transport", choices=("inproc", "http"), default="inproc")
+    ap.add_argument("--save", action="store_true")
+    a = ap.parse_args()
+    asyncio.run(main(a.updates, a.users, a.concurrency, a.seed, a.save, a.transport))
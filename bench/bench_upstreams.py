@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""سيناريوهات سلوك البوت تحت مزوّدين سريعين/بطيئين/متعثّرين/محدودي المعدل — بالكامل ضد المحاكي المحلي.
+
+    python bench/bench_upstreams.py [--n 30] [--concurrency 10] [--scenario all|healthy|slow|flaky|ratelimited|ai_slow]
+
+لكل سيناريو ولكل عملية (fetch_geo, urlscan_lookup, kickbox_lookup, paylink_create_invoice, ai_reply_streaming, link_scan):
+عدد النجاح/الفشل/المهلة و p50/p95/p99، ثم عدّادات المحاكي (طلبات، 500، 429).
+"""
+import argparse, asyncio, os, time
+from fake_upstreams import UpstreamSim, DEFAULT_PROFILE
+
+sim = UpstreamSim()
+os.environ.update(sim.reserve())          # قبل import bot: العناوين والمفاتيح تُقرأ عند الاستيراد
+os.environ.setdefault("AI_CACHE_MODES", "")
+from _boot import bot, summary
+
+SCENARIOS = {
+    "healthy":     {},
+    "slow":        {"ipapi": {"latency": ("lognormal", 2.0, 0.4)}, "urlscan": {"latency": ("fixed", 12.0)},
+                    "kickbox": {"latency": ("uniform", 1.0, 4.0)}, "paylink": {"latency": ("lognormal", 3.0, 0.3)}},
+    "flaky":       {None: {"error_rate": 0.3}},
+    "ratelimited": {None: {"rps": 5}},
+    "ai_slow":     {"openai": {"latency": ("fixed", 3.0), "token_delay": 0.1}},
+}
+
+class FakeMessage:
+    async def reply_text(self, *a, **k): return self
+    async def edit_text(self, *a, **k): pass
+
+def _ops(port):
+    site = f"http://127.0.0.1:{port}/"
+    return {
+        "fetch_geo":   (lambda i: bot.fetch_geo(f"8.8.{i % 250}.{i % 200}"), lambda r: r.get("status") == "success"),
+        "urlscan":     (lambda i: bot.urlscan_lookup(f"{site}p{i}"), lambda r: "urlscan: https://" in r),
+        "kickbox":     (lambda i: bot.kickbox_lookup(f"user{i}@example.com"), lambda r: "deliverable" in r),
+        "paylink":     (lambda i: bot.paylink_create_invoice(f"bench-{i}-{time.time_ns()}", 10.0, "Bench"), lambda r: bool(r[0])),
+        "ai_reply":    (lambda i: bot.ai_reply_streaming(FakeMessage(), "ai_chat", f"hello #{i}"), lambda r: r is not None and "simulated reply" in r),
+        "link_scan":   (lambda i: bot.link_scan(f"{site}p{i}"), lambda r: "urlscan: https://" in r),
+    }
+
+async def run_op(make, ok, n, concurrency):
+    lat, res = [], {"ok": 0, "fail": 0, "timeout": 0, "error": 0}
+    it = iter(range(n))
+    async def worker():
+        for i in it:
+            t = time.perf_counter()
+            try:
+                r = await make(i)
+                res["ok" if ok(r) else "timeout" if bot.PROBE_TIMEOUT_TXT in str(r) else "fail"] += 1
+            except Exception:
+                res["error"] += 1
+            lat.append(time.perf_counter() - t)
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return lat, res
+
+async def main(n, concurrency, which):
+    await sim.start()
+    bot.init_db()
+    await bot._adb.start()
+    ops = _ops(sim.ports["ipapi"])
+    for name, cfg in SCENARIOS.items():
+        if which not in ("all", name): continue
+        sim.configure(None, **DEFAULT_PROFILE)
+        for up, kw in cfg.items(): sim.configure(up, **kw)
+        sim.reset_stats(); bot._paylink_tokens.invalidate(); bot._dns.cache.clear()
+        print(f"\n=== {name} ===")
+        t0 = time.perf_counter()
+        for op, (make, ok) in ops.items():
+            lat, res = await run_op(make, ok, n, concurrency)
+            print(summary(op, lat), " ".join(f"{k}={v}" for k, v in res.items()))
+        print(f"wall={time.perf_counter() - t0:.1f}s sim: " + " ".join(
+            f"{u}[req={s['requests']} 500={s['errors']} 429={s['limited']}]" for u, s in sim.stats.items()))
+    await bot._http.close(); await bot._adb.close(); await sim.close()
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--n", type=int, default=30)
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--scenario", default="all", choices=["all", *SCENARIOS])
+    a = ap.parse_args()
+    asyncio.run(main(a.n, a.concurrency, a.scenario))
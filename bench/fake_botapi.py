@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Bot API وهمي يكفي لتشغيل build_application() محلياً: يرد على كل method بنتيجة صالحة لـ PTB.
+
+وضعان: request() = BaseRequest داخل العملية (بدون sockets، يعزل كلفة البوت نفسه)،
+و start() = خادم aiohttp على 127.0.0.1 يُوجَّه إليه البوت عبر TELEGRAM_API_BASE (يشمل كلفة httpx).
+"""
+import asyncio, itertools, json, time
+from aiohttp import web
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+CHANNEL = {"id": -1001234567890, "type": "channel", "title": "Bench channel", "username": "benchchan",
+           "accent_color_id": 0, "max_reaction_count": 11}
+_MESSAGE_METHODS = {"sendmessage", "editmessagetext", "sendphoto", "sendanimation", "senddocument", "editmessagereplymarkup"}
+
+class FakeBotAPI:
+    def __init__(self, latency=0.0, member_status="member"):
+        self.latency, self.member_status = latency, member_status
+        self.calls = {}
+        self._ids = itertools.count(1000)
+        self._runner = None
+        self.base = ""
+
+    async def answer(self, method: str, params: dict) -> dict:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency: await asyncio.sleep(self.latency)
+        m = method.lower()
+        if m == "getme": result = BOT_USER
+        elif m == "getchat": result = CHANNEL
+        elif m == "getchatmember":
+            result = {"status": self.member_status, "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "U"}}
+        elif m in _MESSAGE_METHODS:
+            result = {"message_id": next(self._ids), "date": int(time.time()), "text": params.get("text") or "ok",
+                      "chat": {"id": int(params.get("chat_id") or 0), "type": "private"}, "from": BOT_USER}
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    # --- in-process ---
+    def request(self) -> BaseRequest:
+        api = self
+        class _Request(BaseRequest):
+            async def initialize(self): pass
+            async def shutdown(self): pass
+            async def do_request(self, url, method, request_data=None, **_):
+                params = request_data.parameters if request_data else {}
+                return 200, json.dumps(await api.answer(url.rsplit("/", 1)[-1], params)).encode()
+        return _Request()
+
+    # --- HTTP ---
+    async def _handle(self, request: web.Request):
+        params = dict(await request.post()) if request.can_read_body else {}
+        return web.json_response(await self.answer(request.match_info["method"], params))
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def close(self):
+        if self._runner: await self._runner.cleanup()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""محاكي محلي (aiohttp) للمزوّدين الخارجيين: Paylink و ip-api و urlscan و Kickbox و OpenAI (مع بث SSE).
+
+لكل مزوّد خادم على منفذ مستقل (حتى تبقى تسميات bot_upstream_* صحيحة) وملف سلوك قابل للتغيير أثناء التشغيل:
+    latency     ("fixed", s) | ("uniform", a, b) | ("lognormal", median_s, sigma)
+    error_rate  نسبة ردود 500
+    rps         حد طلبات/ث (0 = بلا حد)؛ الزائد يرد 429 مع Retry-After
+    token_delay (openai فقط) الفاصل بين أجزاء البث؛ latency = زمن أول جزء
+
+OpenAI يحاكي أيضاً كاش البادئة: usage.prompt_tokens_details.cached_tokens = أطول بادئة رسائل سبق إرسالها
+(عند stream_options.include_usage)، لقياس أثر ترتيب الـ prompt.
+
+    sim = UpstreamSim(); os.environ.update(sim.reserve())   # قبل import bot
+    await sim.start(); sim.configure("ipapi", latency=("fixed", 2.0), error_rate=0.2)
+"""
+import asyncio, hashlib, json, math, random, socket, time, uuid
+from aiohttp import web
+
+NAMES = ("paylink", "ipapi", "urlscan", "kickbox", "openai")
+DEFAULT_PROFILE = {"latency": ("lognormal", 0.05, 0.5), "error_rate": 0.0, "rps": 0, "token_delay": 0.01}
+AI_REPLY = "This is a simulated reply from the local upstream stand-in used for offline benchmarks."
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+class UpstreamSim:
+    def __init__(self, seed=1):
+        self.rng = random.Random(seed)
+        self.profiles = {n: dict(DEFAULT_PROFILE) for n in NAMES}
+        self.stats = {n: {"requests": 0, "errors": 0, "limited": 0} for n in NAMES}
+        self.ports = {}
+        self._buckets = {n: [0.0, time.monotonic()] for n in NAMES}
+        self._runners = []
+        self._prefixes = set()   # hashes بادئات الرسائل المرسلة سابقاً (كاش بادئة OpenAI)
+
+    def configure(self, name=None, **kw):
+        for n in ([name] if name else NAMES): self.profiles[n].update(kw)
+        if "rps" in kw:
+            for n in ([name] if name else NAMES): self._buckets[n] = [float(kw["rps"] or 0), time.monotonic()]
+
+    def reset_stats(self):
+        for s in self.stats.values(): s.update(requests=0, errors=0, limited=0)
+
+    def reserve(self) -> dict:
+        """يحجز المنافذ ويرجع متغيرات البيئة التي توجّه bot.py إلى المحاكي."""
+        self.ports = {n: _free_port() for n in NAMES}
+        b = {n: f"http://127.0.0.1:{p}" for n, p in self.ports.items()}
+        return {"PAYLINK_API_BASE": f"{b['paylink']}/api", "IPAPI_BASE": b["ipapi"],
+                "URLSCAN_API_BASE": f"{b['urlscan']}/api/v1", "KICKBOX_API_BASE": f"{b['kickbox']}/v2",
+                "OPENAI_BASE_URL": f"{b['openai']}/v1",
+                "PAYLINK_API_ID": "sim", "PAYLINK_API_SECRET": "sim", "URLSCAN_API_KEY": "sim",
+                "KICKBOX_API_KEY": "sim", "OPENAI_API_KEY": "sim"}
+
+    # --- سلوك مشترك ---
+    def _delay(self, name) -> float:
+        kind, *a = self.profiles[name]["latency"]
+        if kind == "fixed": return a[0]
+        if kind == "uniform": return self.rng.uniform(a[0], a[1])
+        return a[0] * math.exp(self.rng.gauss(0, a[1]))   # lognormal حول الوسيط
+
+    def _limited(self, name) -> bool:
+        rps = self.profiles[name]["rps"]
+        if not rps: return False
+        b = self._buckets[name]; now = time.monotonic()
+        b[0] = min(rps, b[0] + (now - b[1]) * rps); b[1] = now
+        if b[0] < 1: return True
+        b[0] -= 1; return False
+
+    async def _gate(self, name):
+        """None = تابع الرد الطبيعي، وإلا رد خطأ جاهز."""
+        st = self.stats[name]; st["requests"] += 1
+        if self._limited(name):
+            st["limited"] += 1
+            return web.json_response({"error": "rate limited", "message": "Too Many Requests"}, status=429, headers={"Retry-After": "1"})
+        await asyncio.sleep(self._delay(name))
+        if self.rng.random() < self.profiles[name]["error_rate"]:
+            st["errors"] += 1
+            return web.json_response({"error": "simulated failure", "message": "Internal Server Error"}, status=500)
+        return None
+
+    # --- المزوّدون ---
+    async def _paylink(self, request):
+        if (r := await self._gate("paylink")) is not None: return r
+        if request.match_info["op"] == "auth":
+            return web.json_response({"token": f"sim-{uuid.uuid4().hex}"})
+        body = await request.json()
+        return web.json_response({"url": f"https://pay.sim/invoice/{body.get('orderNumber')}",
+                                  "transactionNo": uuid.uuid4().hex[:12], "orderStatus": "Pending"})
+
+    async def _ipapi(self, request):
+        if (r := await self._gate("ipapi")) is not None: return r
+        return web.json_response({"status": "success", "query": request.match_info["q"], "country": "Saudi Arabia",
+                                  "regionName": "Riyadh", "city": "Riyadh", "zip": "11564", "timezone": "Asia/Riyadh",
+                                  "isp": "Sim ISP", "org": "Sim Org", "as": "AS64500 Sim", "lat": 24.7, "lon": 46.7})
+
+    async def _head(self, request):
+        return web.Response(status=200)
+
+    async def _urlscan(self, request):
+        if (r := await self._gate("urlscan")) is not None: return r
+        sid = uuid.uuid4()
+        return web.json_response({"message": "Submission successful", "uuid": str(sid), "result": f"https://urlscan.sim/result/{sid}/"})
+
+    async def _kickbox(self, request):
+        if (r := await self._gate("kickbox")) is not None: return r
+        return web.json_response({"result": "deliverable", "reason": "accepted_email", "email": request.query.get("email")})
+
+    def _usage(self, messages) -> dict:
+        h, cached, total = hashlib.sha256(), 0, 0
+        for m in messages:
+            h.update(json.dumps(m, sort_keys=True, ensure_ascii=False).encode())
+            total += len(m.get("content") or "") // 3 + 1
+            key = h.hexdigest()
+            if key in self._prefixes: cached = total
+            self._prefixes.add(key)
+        return {"prompt_tokens": total, "completion_tokens": len(AI_REPLY) // 4, "total_tokens": total + len(AI_REPLY) // 4,
+                "prompt_tokens_details": {"cached_tokens": cached}}
+
+    async def _openai(self, request):
+        if (r := await self._gate("openai")) is not None: return r
+        body = await request.json()
+        model, words = body.get("model", "sim"), AI_REPLY.split(" ")
+        usage = self._usage(body.get("messages") or [])
+        if not body.get("stream"):
+            return web.json_response({"id": "sim", "object": "chat.completion", "created": int(time.time()), "model": model,
+                                      "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": AI_REPLY}}], "usage": usage})
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        for i, w in enumerate(words):
+            chunk = {"id": "sim", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": {"content": (" " if i else "") + w}, "finish_reason": None}]}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if i + 1 < len(words): await asyncio.sleep(self.profiles["openai"]["token_delay"])
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {"id": "sim", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [], "usage": usage}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def start(self):
+        if not self.ports: self.reserve()
+        routes = {
+            "paylink": [web.post("/api/{op}", self._paylink)],
+            "ipapi": [web.get("/json/{q}", self._ipapi), web.route("*", "/", self._head)],
+            "urlscan": [web.post("/api/v1/scan/", self._urlscan)],
+            "kickbox": [web.get("/v2/verify", self._kickbox)],
+            "openai": [web.post("/v1/chat/completions", self._openai)],
+        }
+        for name, rs in routes.items():
+            app = web.Application(); app.add_routes(rs)
+            runner = web.AppRunner(app, access_log=None); await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", self.ports[name]).start()
+            self._runners.append(runner)
+        return self
+
+    async def close(self):
+        for r in self._runners: await r.cleanup()
+        self._runners = []
@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
-import os, re, json, time, base64, hashlib, logging, asyncio, sqlite3, tempfile, socket, threading, shutil
+import os, re, io, sys, json, time, math, base64, hashlib, logging, asyncio, sqlite3, tempfile, socket, threading, shutil, ipaddress, csv
+from array import array
+from bisect import bisect_left, bisect_right
+from contextvars import ContextVar
 from pathlib import Path
 from html import escape as _escape
+from urllib.parse import urlparse
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 log = logging.getLogger("bot")
 
 # ========= Optional: OpenAI =========
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI
 except Exception:
-    OpenAI = None
+    AsyncOpenAI = None
 
 # ========= Telegram =========
 from telegram import (
@@ -18,11 +22,12 @@ from telegram import (
     InputFile, BotCommand, BotCommandScopeDefault, BotCommandScopeChat
 )
 from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler,
-    ContextTypes, MessageHandler, filters
+    Application, CommandHandler, CallbackQueryHandler, ChatMemberHandler,
+    ContextTypes, MessageHandler, TypeHandler, filters
 )
+from telegram.request import HTTPXRequest
 from telegram.constants import ChatMemberStatus, ChatAction
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 
 # ========= Others =========
 import aiohttp
@@ -38,9 +43,10 @@ except Exception:
     pywhois = None
 try:
     import dns.resolver as dnsresolver
+    import dns.asyncresolver as dnsasync
     import dns.exception as dnsexception
 except Exception:
-    dnsresolver = None
+    dnsresolver = dnsasync = None
 
 # -------------------- ENV --------------------
 if Path(".env").exists() and not os.getenv("RENDER"):
@@ -57,6 +63,7 @@ MAIN_CHANNEL_USERNAMES = [u.strip().lstrip("@") for u in (os.getenv("MAIN_CHANNE
 MAIN_CHANNEL_LINK = f"https://t.me/{MAIN_CHANNEL_USERNAMES[0]}" if MAIN_CHANNEL_USERNAMES else ""
 
 PUBLIC_BASE_URL = (os.getenv("PUBLIC_BASE_URL") or "").rstrip("/")
+TELEGRAM_API_BASE = (os.getenv("TELEGRAM_API_BASE") or "").rstrip("/")   # خادم Bot API محلي/وهمي بدل api.telegram.org
 SERVE_HEALTH = os.getenv("SERVE_HEALTH","1") == "1"
 
 WELCOME_ANIMATION = (os.getenv("WELCOME_ANIMATION") or "").strip()  # gif/mp4/file_id (تجنّب webp كأنيميشن)
@@ -66,7 +73,14 @@ WELCOME_PHOTO = (os.getenv("WELCOME_PHOTO") or "").strip()          # بديل 
 OPENAI_API_KEY = (os.getenv("OPENAI_API_KEY") or "").strip()
 OPENAI_CHAT_MODEL = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
 OPENAI_VISION = os.getenv("OPENAI_VISION","0") == "1"
-AI_ENABLED = bool(OPENAI_API_KEY) and (OpenAI is not None)
+OPENAI_BASE_URL = (os.getenv("OPENAI_BASE_URL") or "").strip().rstrip("/")   # فارغ = api.openai.com
+AI_ENABLED = bool(OPENAI_API_KEY) and (AsyncOpenAI is not None)
+AI_CACHE_MODES = {m.strip() for m in os.getenv("AI_CACHE_MODES","translate").split(",") if m.strip()}  # writer/ai_chat اختيارية
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE","2000") or "2000")
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", str(7*24*3600)) or "0")
+AI_STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL","1.0") or "1.0")  # أقل فاصل بين تعديلات الرسالة أثناء البث
+AI_CHAT_HISTORY_TOKENS = int(os.getenv("AI_CHAT_HISTORY_TOKENS","1500") or "0")  # سقف الأدوار الأخيرة المرسلة مع كل رسالة (0 = بلا ذاكرة)
+AI_CHAT_SUMMARY_TOKENS = int(os.getenv("AI_CHAT_SUMMARY_TOKENS","300") or "300")  # سقف ملخص الأدوار القديمة
 _openai_client = None
 
 REPLICATE_API_TOKEN = (os.getenv("REPLICATE_API_TOKEN") or "").strip()
@@ -89,6 +103,10 @@ VIP_PRICE_SAR = float(os.getenv("VIP_PRICE_SAR","10") or "10")
 URLSCAN_API_KEY = (os.getenv("URLSCAN_API_KEY") or "").strip()
 KICKBOX_API_KEY = (os.getenv("KICKBOX_API_KEY") or "").strip()
 IPINFO_TOKEN    = (os.getenv("IPINFO_TOKEN") or "").strip()
+# عناوين المزوّدين قابلة للتوجيه (محاكي محلي/بروكسي)
+IPAPI_BASE       = os.getenv("IPAPI_BASE","http://ip-api.com").rstrip("/")
+URLSCAN_API_BASE = os.getenv("URLSCAN_API_BASE","https://urlscan.io/api/v1").rstrip("/")
+KICKBOX_API_BASE = os.getenv("KICKBOX_API_BASE","https://api.kickbox.com/v2").rstrip("/")
 
 # Courses
 COURSE_PYTHON_URL = os.getenv("COURSE_PYTHON_URL","")
@@ -113,12 +131,230 @@ MAX_UPLOAD_BYTES = MAX_UPLOAD_MB * 1024 * 1024
 # ------------- helpers -------------
 def _ensure_openai():
     global _openai_client
-    if _openai_client is None and AI_ENABLED and OpenAI is not None:
+    if _openai_client is None and AI_ENABLED and AsyncOpenAI is not None:
         try:
-            _openai_client = OpenAI(api_key=OPENAI_API_KEY)
+            _openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL or None)
         except Exception as e:
             log.error("[openai] init failed: %s", e)
 
+class TTLCache:
+    """كاش LRU محدود الحجم مع صلاحية (ttl بالثواني) اختيارية لكل عنصر. آمن بين الثريدات."""
+    def __init__(self, maxsize=10000, ttl=None):
+        from collections import OrderedDict
+        self.maxsize, self.ttl = maxsize, ttl
+        self._d = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._d.get(key)
+            if item is None or (item[1] and item[1] <= time.monotonic()):
+                if item is not None: del self._d[key]
+                self.misses += 1
+                return default
+            self._d.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._d[key] = (value, time.monotonic() + ttl if ttl else 0)
+            self._d.move_to_end(key)
+            while len(self._d) > self.maxsize:
+                self._d.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._d.pop(key, None)
+            return item[0] if item else default
+
+    def clear(self):
+        with self._lock: self._d.clear()
+
+    def __len__(self):
+        return len(self._d)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        return f"size={len(self)}/{self.maxsize} hits={self.hits} misses={self.misses} ratio={(self.hits/total if total else 0):.2f}"
+
+# مهام خلفية: مرجع قوي حتى لا يجمعها الـ GC أثناء التشغيل، وتسجيل الاستثناءات بدل ضياعها
+_bg_tasks = set()
+
+def _bg_done(t: asyncio.Task):
+    _bg_tasks.discard(t)
+    if not t.cancelled() and t.exception() is not None:
+        log.error("[bg] %s failed: %r", t.get_name(), t.exception())
+
+def spawn(coro, name: str) -> asyncio.Task:
+    t = asyncio.create_task(coro, name=name)
+    _bg_tasks.add(t); t.add_done_callback(_bg_done)
+    return t
+
+class SingleFlight:
+    """يدمج الاستدعاءات المتزامنة لنفس المفتاح في استدعاء واحد يشترك الجميع في نتيجته."""
+    def __init__(self):
+        self._inflight = {}
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(fn())
+            self._inflight[key] = fut
+            fut.add_done_callback(lambda _f, k=key: self._inflight.pop(k, None))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(fut)
+
+# ------------- metrics -------------
+# سجل مقاييس داخلي بصيغة Prometheus text: التسجيل = عملية dict + bisect فقط، والتجميع يحدث عند طلب /metrics.
+# (الكتابة من ثريدات DB بدون قفل: قد تضيع زيادة نادرة تحت السباق، وهذا مقبول لمقاييس تقريبية)
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+def _labels(names, values, le=None):
+    pairs = list(zip(names, values)) + ([("le", le)] if le is not None else [])
+    if not pairs: return ""
+    return "{" + ",".join(f'{n}="{json.dumps(str(v))[1:-1]}"' for n, v in pairs) + "}"
+
+class Counter:
+    kind = "counter"
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._v = {}
+
+    def inc(self, *lv, n=1):
+        self._v[lv] = self._v.get(lv, 0) + n
+
+    def render(self):
+        for lv, v in list(self._v.items()):
+            yield f"{self.name}{_labels(self.labels, lv)} {v}"
+
+class Histogram:
+    kind = "histogram"
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, tuple(buckets)
+        self._v = {}   # labels -> [counts لكل bucket + inf, sum]
+
+    def observe(self, value, *lv):
+        s = self._v.get(lv)
+        if s is None: s = self._v[lv] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def render(self):
+        for lv, (counts, total) in list(self._v.items()):
+            cum = 0
+            for le, c in zip(self.buckets + ("+Inf",), counts):
+                cum += c
+                yield f"{self.name}_bucket{_labels(self.labels, lv, le)} {cum}"
+            yield f"{self.name}_sum{_labels(self.labels, lv)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, lv)} {cum}"
+
+class Collector:
+    """قيم تُقرأ من كائنات قائمة لحظة التصدير (أحجام الطوابير، عدّادات الكاش...). fn() -> [(labels, value)]"""
+    def __init__(self, name, help, labels, fn, kind="gauge"):
+        self.name, self.help, self.labels, self.fn, self.kind = name, help, labels, fn, kind
+
+    def render(self):
+        for lv, v in self.fn():
+            yield f"{self.name}{_labels(self.labels, lv)} {v}"
+
+class Metrics:
+    def __init__(self):
+        self._all = []
+
+    def _add(self, m):
+        self._all.append(m); return m
+
+    def counter(self, name, help, labels=()): return self._add(Counter(name, help, labels))
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS): return self._add(Histogram(name, help, labels, buckets))
+    def collect(self, name, help, labels, fn, kind="gauge"): return self._add(Collector(name, help, labels, fn, kind))
+
+    def render(self) -> str:
+        out = []
+        for m in self._all:
+            out += [f"# HELP {m.name} {m.help}", f"# TYPE {m.name} {m.kind}"]
+            try: out.extend(m.render())
+            except Exception as e: log.warning("[metrics] %s: %s", m.name, e)
+        return "\n".join(out) + "\n"
+
+METRICS = Metrics()
+M_UPDATES = METRICS.counter("bot_updates_total", "Telegram updates received", ("type",))
+M_HANDLER = METRICS.histogram("bot_handler_seconds", "Handler latency", ("handler",))
+M_HANDLER_ERR = METRICS.counter("bot_handler_errors_total", "Handler exceptions", ("handler",))
+M_UPSTREAM = METRICS.histogram("bot_upstream_seconds", "Outbound call latency", ("upstream",))
+M_UPSTREAM_ERR = METRICS.counter("bot_upstream_errors_total", "Outbound call errors", ("upstream", "kind"))
+DB_BUCKETS = (.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5)
+M_DB_WRITE_QUEUE = METRICS.histogram("bot_db_write_queue_seconds", "Time a write waits in the AsyncDB writer queue", buckets=DB_BUCKETS)
+M_DB_WRITE_BATCH = METRICS.histogram("bot_db_write_batch_seconds", "AsyncDB writer batch duration (apply + commit)", buckets=DB_BUCKETS)
+M_DB_READ_WAIT = METRICS.histogram("bot_db_read_wait_seconds", "Time a read waits for a db-read thread", buckets=DB_BUCKETS)
+M_WB_FLUSH = METRICS.histogram("bot_writebehind_flush_seconds", "Write-behind flush latency (one transaction)", ("writer",),
+                               buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1))
+M_WB_BATCH = METRICS.histogram("bot_writebehind_batch_rows", "Rows per write-behind flush", ("writer",),
+                               buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+# ------------- tracing -------------
+# لكل تحديث Trace في contextvar؛ نقاط DB/HTTP/Telegram/OpenAI تضيف مدتها كـ span. بدون Trace نشط = get() واحد فقط.
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS","2000") or "2000")   # 0 = تعطيل سجل التحديثات البطيئة
+
+class Trace:
+    __slots__ = ("handler", "update_id", "user_id", "spans")
+    def __init__(self, handler, update_id, user_id):
+        self.handler, self.update_id, self.user_id = handler, update_id, user_id
+        self.spans = {}   # name -> [count, total_s, max_s]
+
+    def add(self, name, dt):
+        s = self.spans.get(name)
+        if s is None: self.spans[name] = [1, dt, dt]
+        else:
+            s[0] += 1; s[1] += dt
+            if dt > s[2]: s[2] = dt
+
+_trace: ContextVar = ContextVar("trace", default=None)
+
+def trace_add(name: str, dt: float):
+    t = _trace.get()
+    if t is not None: t.add(name, dt)
+
+class span:
+    """with span("db.read"): ... — يقيس الكتلة ويضيفها للـ Trace الحالي إن وُجد."""
+    __slots__ = ("name", "t0")
+    def __init__(self, name): self.name = name
+    def __enter__(self):
+        self.t0 = time.perf_counter(); return self
+    def __exit__(self, *exc):
+        trace_add(self.name, time.perf_counter() - self.t0)
+
+def _log_slow(t: Trace, dt: float):
+    spans = sorted(t.spans.items(), key=lambda kv: -kv[1][1])
+    log.warning("[slow] %s", json.dumps({
+        "handler": t.handler, "ms": round(dt * 1000, 1), "update_id": t.update_id, "user_id": t.user_id,
+        "spans": {k: {"n": n, "ms": round(tot * 1000, 1), "max_ms": round(mx * 1000, 1)} for k, (n, tot, mx) in spans},
+        "untraced_ms": round((dt - sum(v[1] for _, v in spans)) * 1000, 1),
+    }, ensure_ascii=False))
+
+def timed_handler(name, fn):
+    """يغلّف callback لـ PTB: Trace للتحديث، قياس الزمن، عدّ الاستثناءات (تُعاد لـ on_error)، وسجل التحديث البطيء."""
+    async def wrapper(update, context):
+        user = getattr(update, "effective_user", None)
+        tr = Trace(name, getattr(update, "update_id", None), user.id if user else None)
+        token = _trace.set(tr)
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, context)
+        except Exception:
+            M_HANDLER_ERR.inc(name); raise
+        finally:
+            dt = time.perf_counter() - t0
+            _trace.reset(token)
+            M_HANDLER.observe(dt, name)
+            if SLOW_UPDATE_MS and dt * 1000 >= SLOW_UPDATE_MS: _log_slow(tr, dt)
+    wrapper.__name__ = getattr(fn, "__name__", name)
+    return wrapper
+
 def admin_button_url() -> str:
     if OWNER_USERNAME:
         return f"tg://resolve?domain={OWNER_USERNAME}"
@@ -126,77 +362,224 @@ def admin_button_url() -> str:
         return f"tg://user?id={OWNER_ID}"
     return "https://t.me/"
 
-# ========= Health/Webhook server in a separate Thread =========
+# ========= Health/Webhook server (same event loop as PTB) =========
 from aiohttp import web
 
+TG_WEBHOOK = os.getenv("TG_WEBHOOK","0") == "1"   # 1 = استقبال تحديثات تيليجرام عبر ويبهوك بدل long polling
+TG_WEBHOOK_PATH = "/" + (os.getenv("TG_WEBHOOK_PATH","/telegram").strip("/") or "telegram")
+TG_WEBHOOK_SECRET = (os.getenv("TG_WEBHOOK_SECRET") or hashlib.sha256(f"whsec:{BOT_TOKEN}".encode()).hexdigest()[:48]).strip()
+TG_INGEST_QUEUE = int(os.getenv("TG_INGEST_QUEUE","1000") or "1000")
+
 def _public_url(path: str) -> str:
     base = PUBLIC_BASE_URL or (f"https://{os.getenv('RENDER_EXTERNAL_HOSTNAME','')}" if os.getenv("RENDER_EXTERNAL_HOSTNAME") else "")
     return (base or "").rstrip("/") + path
 
 async def _aio_health(_):
-    return web.json_response({"ok": True})
+    out = {"ok": True}
+    if TG_WEBHOOK: out["webhook"] = {**webhook_stats, "queue_depth": update_backlog()}
+    return web.json_response(out)
+
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN") or "").strip()   # إن وُجد: Authorization: Bearer <token>
+
+async def _aio_metrics(request: web.Request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+    return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+# webhook ingest: Telegram -> app.update_queue مع حد أقصى للتحديثات غير المنتهية (503 = تيليجرام يعيد الإرسال لاحقاً)
+class UpdateQueue(asyncio.Queue):
+    """update_queue يعدّ التحديثات المقبولة التي لم تنتهِ معالجتها بعد.
+    PTB يسحب كل تحديث فوراً إلى مهمة تنتظر الـ semaphore (qsize ≈ 0 دائماً)، ويستدعي task_done بعد انتهاء المعالجة."""
+    def __init__(self):
+        super().__init__()
+        self.backlog = 0
+
+    def put_nowait(self, item):
+        super().put_nowait(item); self.backlog += 1
+
+    def task_done(self):
+        super().task_done(); self.backlog -= 1
+
+_updates_queue: UpdateQueue | None = None
+
+def update_backlog() -> int:
+    return _updates_queue.backlog if _updates_queue is not None else 0
+
+webhook_stats = {"accepted": 0, "rejected_full": 0, "bad_secret": 0, "bad_body": 0, "queue_max": TG_INGEST_QUEUE}
+
+async def _tg_webhook(request: web.Request):
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != TG_WEBHOOK_SECRET:
+        webhook_stats["bad_secret"] += 1
+        return web.Response(status=401)
+    ptb = request.app["ptb"]
+    if getattr(ptb.update_queue, "backlog", ptb.update_queue.qsize()) >= TG_INGEST_QUEUE:
+        webhook_stats["rejected_full"] += 1
+        return web.Response(status=503, headers={"Retry-After": "1"})
+    try:
+        update = Update.de_json(await request.json(), ptb.bot)
+    except Exception:
+        webhook_stats["bad_body"] += 1
+        return web.Response(status=400)
+    if update is not None:
+        ptb.update_queue.put_nowait(update)
+        webhook_stats["accepted"] += 1
+    return web.Response(status=200)
+
+_REF_KEYS = ("orderNumber","merchantOrderNumber","merchantOrderNo","ref","reference","customerRef","customerReference")
+_REF_FULL = re.compile(r"\d{6,}-\d{9,}")
 
 def _find_ref(obj):
-    if not obj: return None
-    if isinstance(obj, dict):
-        for k in ("orderNumber","merchantOrderNumber","merchantOrderNo","ref","reference","customerRef","customerReference"):
-            v = obj.get(k)
-            if isinstance(v,str) and re.fullmatch(r"\d{6,}-\d{9,}", v): return v
-        for v in obj.values():
-            r = _find_ref(v)
-            if r: return r
-    if isinstance(obj, (list,tuple)):
-        for v in obj:
-            r = _find_ref(v)
-            if r: return r
-    if isinstance(obj, str):
-        m = re.search(r"(\d{6,}-\d{9,})", obj)
-        if m: return m.group(1)
+    """بحث عمقي (بدون عودية) بنفس ترتيب الأولوية: مفاتيح المرجع المعروفة ثم باقي القيم ثم النصوص."""
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if not o: continue
+        if isinstance(o, dict):
+            for k in _REF_KEYS:
+                v = o.get(k)
+                if isinstance(v, str) and _REF_FULL.fullmatch(v): return v
+            stack.extend(reversed(list(o.values())))
+        elif isinstance(o, (list, tuple)):
+            stack.extend(reversed(o))
+        elif isinstance(o, str):
+            m = _REF_FULL.search(o)
+            if m: return m.group(0)
     return None
 
+# payhook = inbox: نسجّل الإشعار (مع منع التكرار بالـref + hash) ونرد فوراً؛ المنح يتم في PayInboxWorker
+_payhook_seen = TTLCache(5000, ttl=3600)
+payhook_stats = {"received": 0, "duplicates": 0, "no_ref": 0}
+
 async def _payhook(request: web.Request):
     if PAY_WEBHOOK_SECRET and request.headers.get("X-PL-Secret") != PAY_WEBHOOK_SECRET:
         return web.json_response({"ok": False, "error": "bad secret"}, status=401)
+    body = await request.read()
     try:
-        data = await request.json()
+        data = json.loads(body)
     except Exception:
-        data = {"raw": await request.text()}
+        data = {"raw": body.decode("utf-8", "replace")}
     ref = _find_ref(data)
     if not ref:
+        payhook_stats["no_ref"] += 1
         return web.json_response({"ok": False, "error": "no-ref"}, status=200)
-    activated = payments_mark_paid_by_ref(ref, raw=data)
-    log.info("[payhook] ref=%s -> %s", ref, activated)
-    return web.json_response({"ok": True, "ref": ref, "activated": bool(activated)})
+    payhook_stats["received"] += 1
+    key = (ref, hashlib.sha256(body).hexdigest())
+    if _payhook_seen.get(key):
+        payhook_stats["duplicates"] += 1
+        return web.json_response({"ok": True, "ref": ref, "duplicate": True})
+    inserted = await _adb.execute(
+        "INSERT OR IGNORE INTO pay_inbox (ref,payload_hash,raw,received_at) VALUES (?,?,?,?)",
+        (ref, key[1], json.dumps(data, ensure_ascii=False), int(time.time())))
+    _payhook_seen.set(key, True)
+    if not inserted: payhook_stats["duplicates"] += 1
+    _pay_inbox.wake()
+    return web.json_response({"ok": True, "ref": ref, "duplicate": not inserted})
+
+class PayInboxWorker:
+    """يعالج pay_inbox على دفعات: منح VIP في معاملة واحدة ثم إشعار المستخدم في تيليجرام."""
+    def __init__(self, batch=50, poll=10.0):
+        self.batch, self.poll = batch, poll
+        self._event = asyncio.Event()
+        self._task = None
+        self._bot = None
+        self.stats = {"processed": 0, "granted": 0, "already_paid": 0, "unknown_ref": 0, "notify_failed": 0}
+
+    def start(self, bot):
+        self._bot = bot
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._loop(), name="pay-inbox")
+
+    def wake(self):
+        self._event.set()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try: await self._task
+            except (asyncio.CancelledError, Exception): pass
+            self._task = None
+
+    def _apply_batch(self, conn):
+        rows = conn.execute("SELECT id,ref,raw FROM pay_inbox WHERE processed_at IS NULL ORDER BY id LIMIT ?",
+                            (self.batch,)).fetchall()
+        out, done = [], {}
+        now = int(time.time())
+        for r in rows:
+            ref = r["ref"]
+            if ref in done:
+                result = "duplicate"   # إشعار آخر لنفس المرجع في نفس الدفعة
+            else:
+                done[ref] = _payment_apply(conn, ref, r["raw"])
+                result = done[ref][0]
+                out.append((ref, *done[ref]))
+            conn.execute("UPDATE pay_inbox SET processed_at=?, result=? WHERE id=?", (now, result, r["id"]))
+        return out, len(rows)
+
+    async def process_once(self) -> int:
+        applied, n = await _adb.run(self._apply_batch)
+        self.stats["processed"] += n
+        for ref, result, uid in applied:
+            self.stats[result.replace("-", "_")] += 1
+            log.info("[payhook] ref=%s -> %s", ref, result)
+            if result == "granted":
+                _user_cache_grant(uid, int(time.time()))
+                await self._notify(uid)
+        return n
+
+    async def _notify(self, uid):
+        if self._bot is None: return
+        try:
+            lang = (await user_get_async(uid)).get("pref_lang", "ar")
+            await self._bot.send_message(int(uid), T("vip_status_on", lang=lang))
+        except Exception as e:
+            self.stats["notify_failed"] += 1
+            log.warning("[payhook] notify %s: %s", uid, e)
 
-def run_health_server_threaded():
-    """يشغّل aiohttp في ثريد مستقل (لوب مختلف) لتفادي تضارب حلقات asyncio مع run_polling."""
-    if not SERVE_HEALTH:
-        return
-    port = int(os.getenv("PORT","10000"))
+    async def _loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._event.wait(), self.poll)
+            except asyncio.TimeoutError:
+                pass
+            self._event.clear()
+            try:
+                while await self.process_once() >= self.batch:
+                    pass
+            except Exception as e:
+                log.error("[payhook] inbox worker: %s", e)
 
-    def _thread():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        app = web.Application()
-        app.router.add_get("/", _aio_health)
-        app.router.add_get("/health", _aio_health)
-        if PAY_WEBHOOK_ENABLE:
-            app.router.add_post("/payhook", _payhook)
-            app.router.add_get("/payhook", _aio_health)
-        runner = web.AppRunner(app)
-        async def _start():
-            await runner.setup()
-            site = web.TCPSite(runner, "0.0.0.0", port)
-            await site.start()
-            log.info("[http] serving on 0.0.0.0:%d", port)
-        loop.run_until_complete(_start())
-        try:
-            loop.run_forever()
-        finally:
-            loop.run_until_complete(runner.cleanup())
-            loop.close()
+_pay_inbox = PayInboxWorker()
 
-    threading.Thread(target=_thread, daemon=True).start()
+_http_runner = None
+
+async def start_http_server(ptb_app):
+    """يشغّل aiohttp على نفس حلقة PTB: /health و /metrics و /payhook وويبهوك تيليجرام (إن فُعّل)."""
+    global _http_runner
+    if _http_runner is not None or not (SERVE_HEALTH or TG_WEBHOOK):
+        return
+    port = int(os.getenv("PORT","10000"))
+    app = web.Application()
+    app["ptb"] = ptb_app
+    app.router.add_get("/", _aio_health)
+    app.router.add_get("/health", _aio_health)
+    app.router.add_get("/metrics", _aio_metrics)
+    if PAY_WEBHOOK_ENABLE:
+        app.router.add_post("/payhook", _payhook)
+        app.router.add_get("/payhook", _aio_health)
+    if TG_WEBHOOK:
+        app.router.add_post(TG_WEBHOOK_PATH, _tg_webhook)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+    _http_runner = runner
+    log.info("[http] serving on 0.0.0.0:%d%s", port, f" (webhook {TG_WEBHOOK_PATH})" if TG_WEBHOOK else "")
+
+async def stop_http_server():
+    global _http_runner
+    if _http_runner is not None:
+        await _http_runner.cleanup()
+        _http_runner = None
 
 # ffmpeg presence (optional)
 def ffmpeg_path():
@@ -208,114 +591,95 @@ if ffmpeg_path():
 else:
     log.warning("[ffmpeg] missing")
 
+# ------------- HTTP client -------------
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT","100") or "100")
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST","10") or "10")
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE","30") or "30")
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL","300") or "300")
+
+# مهلة كل مزوّد بالثواني — قابلة للتغيير عبر HTTP_TIMEOUT_<NAME>
+UPSTREAM_TIMEOUTS = {
+    name: float(os.getenv(f"HTTP_TIMEOUT_{name.upper()}", str(default)) or default)
+    for name, default in {"default": 20, "paylink": 30, "ipapi": 15, "urlscan": 30, "kickbox": 20, "head": 15}.items()
+}
+
+# تصنيف الطلبات الخارجية حسب (المضيف, المنفذ) لمقاييس bot_upstream_* — يتبع عناوين *_BASE
+def _host_port(base: str):
+    u = urlparse(base)
+    return (u.hostname, u.port or (443 if u.scheme == "https" else 80))
+
+UPSTREAM_HOSTS = {_host_port(b): name for b, name in
+                  ((IPAPI_BASE, "ipapi"), (URLSCAN_API_BASE, "urlscan"), (KICKBOX_API_BASE, "kickbox"), (PAYLINK_API_BASE, "paylink"))}
+
+def _http_trace() -> aiohttp.TraceConfig:
+    tc = aiohttp.TraceConfig()
+    async def on_start(session, ctx, params): ctx.t0 = time.perf_counter()
+    async def on_end(session, ctx, params):
+        up = UPSTREAM_HOSTS.get((params.url.host, params.url.port), "other"); dt = time.perf_counter() - ctx.t0
+        M_UPSTREAM.observe(dt, up); trace_add(f"http.{up}", dt)
+        if params.response.status >= 400: M_UPSTREAM_ERR.inc(up, f"{params.response.status // 100}xx")
+    async def on_exc(session, ctx, params):
+        up = UPSTREAM_HOSTS.get((params.url.host, params.url.port), "other"); dt = time.perf_counter() - ctx.t0
+        M_UPSTREAM.observe(dt, up); trace_add(f"http.{up}", dt)
+        M_UPSTREAM_ERR.inc(up, type(params.exception).__name__)
+    tc.on_request_start.append(on_start); tc.on_request_end.append(on_end); tc.on_request_exception.append(on_exc)
+    return tc
+
+class HttpClient:
+    """جلسة aiohttp واحدة طوال عمر التطبيق: اتصالات keep-alive، حد لكل مضيف، وكاش DNS."""
+    def __init__(self):
+        self._session = None
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE, use_dns_cache=True, ttl_dns_cache=HTTP_DNS_TTL,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout("default"),
+                                                  trace_configs=[_http_trace()])
+        return self._session
+
+    @staticmethod
+    def timeout(upstream: str) -> aiohttp.ClientTimeout:
+        total = UPSTREAM_TIMEOUTS.get(upstream, UPSTREAM_TIMEOUTS["default"])
+        return aiohttp.ClientTimeout(total=total, connect=min(total, 10))
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+_http = HttpClient()
+
 # ------------- i18n -------------
-def T(key: str, lang: str | None = None, **kw) -> str:
-    AR = {
-        "start_pick_lang": "اختر لغتك:",
-        "lang_ar": "العربية",
-        "lang_en": "English",
-        "hello_name": "مرحباً {name} 👋\nهذا بوت فيربوكس — عندك: أدوات الذكاء الاصطناعي، الأمن، الخدمات، الدورات، والدفع للـVIP.",
-        "main_menu": "👇 القائمة الرئيسية",
-        "btn_myinfo": "👤 معلوماتي",
-        "btn_lang": "🌐 تغيير اللغة",
-        "btn_vip": "⭐ حساب VIP",
-        "btn_contact": "📨 تواصل مع الإدارة",
-        "btn_sections": "📂 الأقسام",
-        "gate_join": "🔐 انضم للقناة أولاً لاستخدام البوت:",
-        "verify": "✅ تحقّق",
-        "back": "↩️ رجوع",
-        "sections": "📂 الأقسام",
-        "sec_ai": "🤖 أدوات الذكاء الاصطناعي (VIP)",
-        "sec_security": "🛡️ الأمن (VIP)",
-        "sec_services": "🧰 الخدمات",
-        "sec_unban": "🚫 فك الباند",
-        "sec_courses": "🎓 الدورات",
-        "sec_darkgpt": "🕶️ Dark GPT (VIP)",
-        "vip_status_on": "⭐ حسابك VIP (مدى الحياة).",
-        "vip_status_off": "⚡ ترقية إلى VIP مدى الحياة",
-        "verify_done": "👌 تم التحقق.",
-        "not_verified": "❗️ لم يتم التحقق بعد.",
-        "contact_admin": "تواصل مع الإدارة:",
-        "choose_option": "اختر خياراً:",
-        "myinfo": "👤 الاسم: {name}\n🆔 المعرف: {uid}\n🌐 اللغة: {lng}",
-
-        "page_ai": "🤖 أدوات الذكاء الاصطناعي:",
-        "btn_ai_chat": "💬 دردشة",
-        "btn_ai_write": "✍️ كتابة (إعلانات/منشورات)",
-        "btn_ai_translate": "🌐 ترجمة تلقائية (AR ↔ EN)",
-        "btn_ai_image": "🖼️ توليد صور",
-
-        "page_security": "🛡️ أدوات الأمن:",
-        "btn_urlscan": "🔗 فحص رابط",
-        "btn_emailcheck": "📧 فحص إيميل",
-        "btn_geolookup": "🛰️ موقع IP/دومين",
-
-        "page_services": "🧰 الخدمات:",
-        "btn_games": "🎮 الألعاب والاشتراكات",
-
-        "page_courses": "🎓 الدورات:",
-        "course_python": "بايثون من الصفر",
-        "course_cyber": "الأمن السيبراني من الصفر",
-        "course_eh": "الهكر الأخلاقي",
-        "course_ecom": "التجارة الإلكترونية",
-
-        "vip_only": "🚫 هذه الميزة متاحة لمشتركي VIP فقط.",
-    }
-    EN = {
-        "start_pick_lang": "Pick your language:",
-        "lang_ar": "العربية",
-        "lang_en": "English",
-        "hello_name": "Welcome {name}! 👋\nThis is Ferpoks Bot — you’ll find: AI tools, Security, Services, Courses and VIP payments.",
-        "main_menu": "👇 Main menu",
-        "btn_myinfo": "👤 My info",
-        "btn_lang": "🌐 Change language",
-        "btn_vip": "⭐ VIP Account",
-        "btn_contact": "📨 Contact Admin",
-        "btn_sections": "📂 Sections",
-        "gate_join": "🔐 Please join the channel first:",
-        "verify": "✅ Verify",
-        "back": "↩️ Back",
-        "sections": "📂 Sections",
-        "sec_ai": "🤖 AI Tools (VIP)",
-        "sec_security": "🛡️ Security (VIP)",
-        "sec_services": "🧰 Services",
-        "sec_unban": "🚫 Unban",
-        "sec_courses": "🎓 Courses",
-        "sec_darkgpt": "🕶️ Dark GPT (VIP)",
-        "vip_status_on": "⭐ Your VIP is active (lifetime).",
-        "vip_status_off": "⚡ Upgrade to lifetime VIP",
-        "verify_done": "👌 Verified.",
-        "not_verified": "❗️ Not verified yet.",
-        "contact_admin": "Contact admin:",
-        "choose_option": "Choose an option:",
-        "myinfo": "👤 Name: {name}\n🆔 ID: {uid}\n🌐 Lang: {lng}",
-
-        "page_ai": "🤖 AI Tools:",
-        "btn_ai_chat": "💬 Chat",
-        "btn_ai_write": "✍️ Writing (Ads/Posts)",
-        "btn_ai_translate": "🌐 Auto Translate (AR ↔ EN)",
-        "btn_ai_image": "🖼️ Image Gen",
-
-        "page_security": "🛡️ Security tools:",
-        "btn_urlscan": "🔗 URL Scan",
-        "btn_emailcheck": "📧 Email Check",
-        "btn_geolookup": "🛰️ IP/Domain Geo",
-
-        "page_services": "🧰 Services:",
-        "btn_games": "🎮 Games & Subscriptions",
-
-        "page_courses": "🎓 Courses:",
-        "course_python": "Python from Zero",
-        "course_cyber": "Cybersecurity from Zero",
-        "course_eh": "Ethical Hacking",
-        "course_ecom": "E-commerce",
-
-        "vip_only": "🚫 VIP only feature.",
-    }
+# الكتالوج يُحمّل مرة واحدة من locales/<lang>.json؛ كل قالب محفوظ مع علامة (يحتاج format؟)
+LOCALES_DIR = Path(os.getenv("LOCALES_DIR") or Path(__file__).resolve().parent / "locales")
+LANGS = ("ar", "en")
+
+def _load_catalog() -> dict:
+    import string
+    fmt = string.Formatter()
+    cat = {}
+    for lang in LANGS:
+        try:
+            raw = json.loads((LOCALES_DIR / f"{lang}.json").read_text(encoding="utf-8"))
+        except Exception as e:
+            log.error("[i18n] %s: %s", lang, e); raw = {}
+        entries = {}
+        for k, v in raw.items():
+            try: has_fields = any(f is not None for _, f, _, _ in fmt.parse(v))
+            except ValueError: has_fields = True
+            entries[k] = (v, has_fields)
+        cat[lang] = entries
+    return cat
+
+_CATALOG = _load_catalog()
 
-    if lang not in ("ar","en"): lang = "ar"
-    D = AR if lang=="ar" else EN
-    s = D.get(key, key)
+def T(key: str, lang: str | None = None, **kw) -> str:
+    if lang not in LANGS: lang = "ar"
+    s, has_fields = _CATALOG[lang].get(key, (key, False))
+    if not has_fields: return s
     try:
         kw = {k:_escape(str(v)) for k,v in kw.items()}
         return s.format(**kw)
@@ -323,21 +687,229 @@ def T(key: str, lang: str | None = None, **kw) -> str:
         return s
 
 # ------------- DB -------------
+DB_READERS = int(os.getenv("DB_READERS","4") or "4")
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH","64") or "64")
+
+def _db_connect() -> sqlite3.Connection:
+    Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE","5000") or "5000")
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL","300") or "300")
+
 _db_lock = threading.RLock()
 def _db():
     conn = getattr(_db, "_conn", None)
     if conn is not None: return conn
-    Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    conn = _db_connect()
     _db._conn = conn
-    log.info("[db] %s", DB_PATH)
+    log.info("[db] %s (WAL)", DB_PATH)
     return conn
 
-def migrate_db():
-    with _db_lock:
-        _db().execute("""
-        CREATE TABLE IF NOT EXISTS users (
+class AsyncDB:
+    """طبقة تخزين غير متزامنة: قرّاء متعددون في ثريدات + كاتب واحد يطبّق الكتابات المجمّعة في معاملة واحدة."""
+    def __init__(self, readers=4, batch=64):
+        self._readers = max(1, readers)
+        self._batch = max(1, batch)
+        self._rpool = self._wpool = None
+        self._local = threading.local()
+        self._conns = []
+        self._wconn = None
+        self._queue = None
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running: return
+        from concurrent.futures import ThreadPoolExecutor
+        self._rpool = ThreadPoolExecutor(max_workers=self._readers, thread_name_prefix="db-read")
+        self._wpool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._writer_loop(), name="db-writer")
+        log.info("[db] async storage: readers=%d batch=%d", self._readers, self._batch)
+
+    async def close(self):
+        if not self.running: return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._rpool.shutdown(wait=True); self._wpool.shutdown(wait=True)
+        for c in self._conns + ([self._wconn] if self._wconn else []):
+            try: c.close()
+            except Exception: pass
+        self._conns, self._wconn = [], None
+
+    # --- reads ---
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = _db_connect()
+            self._conns.append(conn)
+        return conn
+
+    def _fetch(self, sql, params, one, t_sub):
+        M_DB_READ_WAIT.observe(time.perf_counter() - t_sub)
+        c = self._reader().execute(sql, params)
+        if one:
+            r = c.fetchone()
+            return dict(r) if r else None
+        return [dict(r) for r in c.fetchall()]
+
+    async def fetchone(self, sql: str, params=()) -> dict | None:
+        with span("db.read"):
+            return await asyncio.get_running_loop().run_in_executor(self._rpool, self._fetch, sql, params, True, time.perf_counter())
+
+    async def fetchall(self, sql: str, params=()) -> list[dict]:
+        with span("db.read"):
+            return await asyncio.get_running_loop().run_in_executor(self._rpool, self._fetch, sql, params, False, time.perf_counter())
+
+    # --- writes ---
+    async def execute(self, sql: str, params=(), wait=True):
+        """يضيف كتابة إلى طابور الكاتب. wait=False يرجع فوراً (الترتيب FIFO مضمون)."""
+        return await self.run(lambda conn: conn.execute(sql, params).rowcount, wait=wait)
+
+    async def run(self, fn, wait=True):
+        """ينفّذ fn(conn) داخل معاملة الكاتب ويرجع نتيجتها."""
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, fut, time.perf_counter()))
+        if not wait:
+            fut.add_done_callback(_db_log_failed_write)
+            return None
+        with span("db.write"):
+            return await fut
+
+    def _apply(self, batch):
+        if self._wconn is None:
+            self._wconn = _db_connect()
+        conn, out = self._wconn, []
+        t0 = time.perf_counter()
+        for _, _, t_enq in batch: M_DB_WRITE_QUEUE.observe(t0 - t_enq)
+        if not conn.in_transaction: conn.execute("BEGIN")
+        for fn, _, _ in batch:
+            # كل عنصر داخل savepoint: العنصر الفاشل لا يترك أثراً، والبقية تُحفظ في نفس الـ commit
+            conn.execute("SAVEPOINT item")
+            try:
+                out.append((True, fn(conn)))
+            except Exception as e:
+                conn.execute("ROLLBACK TO item"); out.append((False, e))
+            conn.execute("RELEASE item")
+        try:
+            self._wconn.commit()
+        except Exception as e:
+            self._wconn.rollback()
+            out = [(False, e)] * len(batch)
+        M_DB_WRITE_BATCH.observe(time.perf_counter() - t0)
+        return out
+
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        stop = False
+        while not stop:
+            item = await self._queue.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self._batch or self._queue.empty(): break
+                item = self._queue.get_nowait()
+            stop = item is None
+            if not batch: continue
+            try:
+                results = await loop.run_in_executor(self._wpool, self._apply, batch)
+            except Exception as e:
+                results = [(False, e)] * len(batch)
+            for (_, fut, _), (ok, val) in zip(batch, results):
+                if fut.done(): continue
+                if ok: fut.set_result(val)
+                else: fut.set_exception(val)
+
+def _db_log_failed_write(fut):
+    if not fut.cancelled() and fut.exception() is not None:
+        log.error("[db] background write failed: %s", fut.exception())
+
+_adb = AsyncDB(readers=DB_READERS, batch=DB_WRITE_BATCH)
+
+class WriteBehind:
+    """تعديلات مفتاح→قيمة تتجمّع في الذاكرة (الأحدث يغلب، أو merge(old, new)) وتُكتب في معاملة واحدة
+    على كاتب _adb كل interval_ms أو عند بلوغ max_pending مفتاحاً، ومرة أخيرة عند close()."""
+    def __init__(self, name, apply, interval_ms=500, max_pending=200, merge=None):
+        self.name, self._apply, self._merge = name, apply, merge
+        self.interval, self.max_pending = interval_ms / 1000, max(1, max_pending)
+        self._pending = {}
+        self._inflight = {}   # الدفعة التي تُكتب الآن (تبقى مرئية لـ pending حتى الـ commit)
+        self._wake = None
+        self._task = None
+        self.flushes = self.rows = self.failures = 0
+
+    def put(self, key, value):
+        if self._merge is not None and key in self._pending: value = self._merge(self._pending[key], value)
+        self._pending[key] = value
+        if len(self._pending) >= self.max_pending and self._wake is not None: self._wake.set()
+
+    def pending(self, key, default=None):
+        """القيمة غير المكتوبة بعد لهذا المفتاح (المعلّقة فوق الجاري كتابتها)."""
+        v, f = self._pending.get(key), self._inflight.get(key)
+        if f is None: return default if v is None else v
+        if v is None: return f
+        return self._merge(f, v) if self._merge else v
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self):
+        if self._task is not None: return
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._loop(), name=f"writebehind-{self.name}")
+
+    async def flush(self) -> int:
+        if not self._pending: return 0
+        batch, self._pending = self._pending, {}
+        self._inflight = batch
+        t0 = time.perf_counter()
+        try:
+            await _adb.run(lambda conn: self._apply(conn, batch))
+        except Exception as e:
+            self._inflight = {}
+            self.failures += 1
+            log.error("[db] %s flush of %d rows failed: %s", self.name, len(batch), e)
+            for k, v in batch.items():   # يعود للطابور؛ ما وصل بعد السحب أحدث منه
+                newer = self._pending.get(k)
+                self._pending[k] = v if newer is None else (self._merge(v, newer) if self._merge else newer)
+            return 0
+        self._inflight = {}
+        self.flushes += 1; self.rows += len(batch)
+        M_WB_FLUSH.observe(time.perf_counter() - t0, self.name); M_WB_BATCH.observe(len(batch), self.name)
+        return len(batch)
+
+    async def _loop(self):
+        while True:
+            try: await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError: pass
+            self._wake.clear()
+            await self.flush()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = self._wake = None
+        await self.flush()
+
+    def stats(self) -> str:
+        return f"{self.name}: pending={len(self._pending)} flushes={self.flushes} rows={self.rows} failures={self.failures}"
+
+# ترحيلات مرتّبة بأرقام إصدارات؛ كل ترحيل يُطبّق مرة واحدة فقط (عند تشغيل main)
+SCHEMA_MIGRATIONS = [
+    (1, "base tables", [
+        """CREATE TABLE IF NOT EXISTS users (
           id TEXT PRIMARY KEY,
           premium INTEGER DEFAULT 0,
           verified_ok INTEGER DEFAULT 0,
@@ -345,16 +917,14 @@ def migrate_db():
           vip_forever INTEGER DEFAULT 0,
           vip_since INTEGER DEFAULT 0,
           pref_lang TEXT DEFAULT 'ar'
-        );""")
-        _db().execute("""
-        CREATE TABLE IF NOT EXISTS ai_state (
+        );""",
+        """CREATE TABLE IF NOT EXISTS ai_state (
           user_id TEXT PRIMARY KEY,
           mode TEXT,
           extra TEXT,
           updated_at INTEGER
-        );""")
-        _db().execute("""
-        CREATE TABLE IF NOT EXISTS payments (
+        );""",
+        """CREATE TABLE IF NOT EXISTS payments (
           ref TEXT PRIMARY KEY,
           user_id TEXT,
           amount REAL,
@@ -363,115 +933,332 @@ def migrate_db():
           created_at INTEGER,
           paid_at INTEGER,
           raw TEXT
-        );""")
-        _db().commit()
+        );""",
+    ]),
+    (2, "payments/vip indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_status ON payments(user_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_users_vip ON users(vip_since) WHERE vip_forever=1 OR premium=1",
+    ]),
+    (3, "ai response cache", [
+        """CREATE TABLE IF NOT EXISTS ai_cache (
+          key TEXT PRIMARY KEY,
+          mode TEXT,
+          response TEXT,
+          created_at INTEGER,
+          expires_at INTEGER
+        );""",
+        "CREATE INDEX IF NOT EXISTS idx_ai_cache_expires ON ai_cache(expires_at)",
+    ]),
+    (4, "channel membership state", [
+        """CREATE TABLE IF NOT EXISTS channel_members (
+          user_id TEXT PRIMARY KEY,
+          chat_id INTEGER,
+          is_member INTEGER,
+          status TEXT,
+          updated_at INTEGER
+        );""",
+    ]),
+    (5, "payment webhook inbox", [
+        """CREATE TABLE IF NOT EXISTS pay_inbox (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          ref TEXT,
+          payload_hash TEXT,
+          raw TEXT,
+          received_at INTEGER,
+          processed_at INTEGER,
+          result TEXT,
+          UNIQUE(ref, payload_hash)
+        );""",
+        "CREATE INDEX IF NOT EXISTS idx_pay_inbox_pending ON pay_inbox(id) WHERE processed_at IS NULL",
+    ]),
+]
+
+def schema_version() -> int:
+    with _db_lock:
+        r = _db().execute("SELECT COALESCE(MAX(version),0) FROM schema_version").fetchone()
+        return int(r[0])
+
+def migrate_db():
+    with _db_lock:
+        conn = _db()
+        conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT, applied_at INTEGER)")
+        conn.commit()
+        current = schema_version()
+        for ver, name, stmts in SCHEMA_MIGRATIONS:
+            if ver <= current: continue
+            try:
+                conn.execute("BEGIN")
+                for sql in stmts: conn.execute(sql)
+                conn.execute("INSERT INTO schema_version (version,name,applied_at) VALUES (?,?,?)", (ver, name, int(time.time())))
+                conn.commit()
+            except Exception:
+                conn.rollback(); raise
+            log.info("[db] migration %d applied: %s", ver, name)
 
 def init_db():
     migrate_db()
 
-def user_get(uid) -> dict:
+# users cache (write-through): كل تعديل على users يمر على _user_cache_patch
+_user_cache = TTLCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# جيل الكتابات: قراءة من القرص بدأت قبل آخر كتابة لنفس المستخدم لا تُخزَّن (وإلا تغطي الكتابة حتى انتهاء TTL)
+_user_gen = 0
+_user_written = TTLCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+def _user_cache_patch(uid, **fields):
+    """نسخة جديدة بدل التعديل في المكان حتى تبقى لقطة التحديث الجاري ثابتة."""
+    global _user_gen
     uid = str(uid)
-    with _db_lock:
-        c = _db().cursor()
-        c.execute("SELECT * FROM users WHERE id=?", (uid,))
-        r = c.fetchone()
-        if not r:
-            _db().execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (uid,))
-            _db().commit()
-            return {"id": uid, "premium":0, "verified_ok":0, "verified_at":0, "vip_forever":0, "vip_since":0, "pref_lang":"ar"}
-        return dict(r)
-
-def user_is_vip(uid) -> bool:
-    u = user_get(uid)
+    _user_gen += 1; _user_written.set(uid, _user_gen)
+    u = _user_cache.get(uid)
+    if u is not None:
+        _user_cache.set(uid, {**u, **fields})
+
+def _user_cache_grant(uid, now):
+    u = _user_cache.get(str(uid)) or {}
+    _user_cache_patch(uid, premium=1, vip_forever=1, vip_since=u.get("vip_since") or now)
+
+def user_is_vip_record(u: dict) -> bool:
     return bool(u.get("premium") or u.get("vip_forever"))
 
-def user_grant(uid):
-    now = int(time.time())
-    with _db_lock:
-        _db().execute("UPDATE users SET premium=1, vip_forever=1, vip_since=COALESCE(NULLIF(vip_since,0),?) WHERE id=?", (now, str(uid)))
-        _db().commit()
+# users journal: أعلام المستخدم (التحقق/اللغة) تُدمج لكل مستخدم وتُكتب كل الدفعة في معاملة واحدة
+USER_FLUSH_MS = int(os.getenv("USER_FLUSH_MS","1000") or "1000")
+USER_FLUSH_MAX = int(os.getenv("USER_FLUSH_MAX","500") or "500")
+M_USER_NOOP = METRICS.counter("bot_user_writes_skipped_total", "User flag writes skipped as no-ops", ("field",))
 
-def user_set_verify(uid, ok=True):
-    with _db_lock:
-        _db().execute("UPDATE users SET verified_ok=?, verified_at=? WHERE id=?", (1 if ok else 0, int(time.time()), str(uid)))
-        _db().commit()
+def _users_apply(conn, batch: dict):
+    conn.executemany("INSERT OR IGNORE INTO users (id) VALUES (?)", [(uid,) for uid in batch])
+    groups = {}   # نفس مجموعة الأعمدة -> executemany واحد
+    for uid, fields in batch.items():
+        cols = tuple(sorted(fields))
+        groups.setdefault(cols, []).append((*(fields[c] for c in cols), uid))
+    for cols, rows in groups.items():
+        conn.executemany(f"UPDATE users SET {', '.join(f'{c}=?' for c in cols)} WHERE id=?", rows)
 
-def prefs_set_lang(uid, lang):
-    with _db_lock:
-        _db().execute("UPDATE users SET pref_lang=? WHERE id=?", (lang, str(uid))); _db().commit()
+_user_journal = WriteBehind("users", _users_apply, USER_FLUSH_MS, USER_FLUSH_MAX, merge=lambda old, new: {**old, **new})
 
-def ai_set_mode(uid, mode, extra=None):
-    with _db_lock:
-        _db().execute(
-            "INSERT INTO ai_state (user_id,mode,extra,updated_at) VALUES (?,?,?,strftime('%s','now')) "
-            "ON CONFLICT(user_id) DO UPDATE SET mode=excluded.mode, extra=excluded.extra, updated_at=strftime('%s','now')",
-            (str(uid), mode, json.dumps(extra or {}, ensure_ascii=False))
-        ); _db().commit()
+def user_flags_set(uid, **fields):
+    """تعديل أعلام المستخدم: الكاش فوراً، والقرص عبر _user_journal."""
+    uid = str(uid)
+    _user_journal.put(uid, fields)
+    _user_cache_patch(uid, **fields)
+
+def _user_overlay(u: dict) -> dict:
+    """صف من القرص + ما لم يُكتب بعد في الـ journal."""
+    p = _user_journal.pending(str(u["id"]))
+    return {**u, **p} if p else u
+
+def _verify_unchanged(uid, v) -> bool:
+    u = _user_cache.get(str(uid))
+    if u is None or u.get("verified_ok") != v: return False
+    M_USER_NOOP.inc("verified_ok")
+    return True
 
-def ai_get_mode(uid):
-    with _db_lock:
-        c = _db().cursor()
-        c.execute("SELECT mode,extra FROM ai_state WHERE user_id=?", (str(uid),))
-        r = c.fetchone()
-        if not r: return None, {}
-        try:
-            extra = json.loads(r["extra"] or "{}")
-        except Exception:
-            extra = {}
-        return r["mode"], extra
+def user_set_verify(uid, ok=True):
+    v = 1 if ok else 0
+    if _verify_unchanged(uid, v): return
+    user_flags_set(uid, verified_ok=v, verified_at=int(time.time()))
+
+def prefs_set_lang(uid, lang):
+    user_flags_set(uid, pref_lang=lang)
 
 # payments
 def payments_new_ref(uid) -> str:
     return f"{uid}-{int(time.time())}"
 
-def payments_create(uid, amount, provider="paylink", ref=None) -> str:
+def _payment_apply(conn, ref, raw_text=None) -> tuple[str, str | None]:
+    """يعلّم الدفع مدفوعاً ويمنح VIP في نفس المعاملة. الدفع المدفوع مسبقاً لا يُعاد منحه."""
+    r = conn.execute("SELECT user_id,status FROM payments WHERE ref=?", (ref,)).fetchone()
+    if not r: return "unknown-ref", None
+    if r["status"] == "paid": return "already-paid", r["user_id"]
+    now = int(time.time())
+    conn.execute("UPDATE payments SET status='paid', paid_at=?, raw=? WHERE ref=?", (now, raw_text, ref))
+    conn.execute("UPDATE users SET premium=1, vip_forever=1, vip_since=COALESCE(NULLIF(vip_since,0),?) WHERE id=?", (now, r["user_id"]))
+    return "granted", r["user_id"]
+
+# async (handlers) — عبر _adb بدون حجز حلقة الأحداث
+_USER_DEFAULTS = {"premium":0, "verified_ok":0, "verified_at":0, "vip_forever":0, "vip_since":0, "pref_lang":"ar"}
+
+async def user_get_async(uid) -> dict:
+    uid = str(uid)
+    u = _user_cache.get(uid)
+    if u is not None: return u
+    gen = _user_gen
+    u = await _adb.fetchone("SELECT * FROM users WHERE id=?", (uid,))
+    if not u:
+        await _adb.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (uid,), wait=False)
+        u = {"id": uid, **_USER_DEFAULTS}
+    u = _user_overlay(u)
+    if (_user_written.get(uid) or 0) <= gen: _user_cache.set(uid, u)
+    return u
+
+async def user_is_vip_async(uid, u=None) -> bool:
+    return user_is_vip_record(u if u is not None else await user_get_async(uid))
+
+async def user_grant_async(uid):
+    now = int(time.time())
+    await _adb.execute("UPDATE users SET premium=1, vip_forever=1, vip_since=COALESCE(NULLIF(vip_since,0),?) WHERE id=?",
+                       (now, str(uid)))
+    _user_cache_grant(uid, now)
+
+async def user_revoke_async(uid):
+    await _adb.execute("UPDATE users SET premium=0, vip_forever=0 WHERE id=?", (str(uid),))
+    _user_cache_patch(uid, premium=0, vip_forever=0)
+
+async def user_set_verify_async(uid, ok=True):
+    user_set_verify(uid, ok)
+
+async def prefs_set_lang_async(uid, lang):
+    prefs_set_lang(uid, lang)
+
+# ai_state: الذاكرة هي المرجع أثناء التشغيل؛ SQLite يُحدَّث بالكتابة المؤجلة (WriteBehind) ويُقرأ مرة لكل مستخدم
+AI_STATE_FLUSH_MS = int(os.getenv("AI_STATE_FLUSH_MS","500") or "500")
+AI_STATE_FLUSH_MAX = int(os.getenv("AI_STATE_FLUSH_MAX","200") or "200")
+AI_STATE_CACHE = int(os.getenv("AI_STATE_CACHE","50000") or "50000")
+
+def _ai_state_apply(conn, batch: dict):
+    conn.executemany(
+        "INSERT INTO ai_state (user_id,mode,extra,updated_at) VALUES (?,?,?,?) "
+        "ON CONFLICT(user_id) DO UPDATE SET mode=excluded.mode, extra=excluded.extra, updated_at=excluded.updated_at",
+        [(uid, mode, extra_json, ts) for uid, (mode, extra_json, ts) in batch.items()])
+
+class AIStateStore:
+    """uid -> (mode, extra) في الذاكرة (LRU يُخرج النظيف فقط). الكتابة فورية في الذاكرة ومؤجلة إلى القرص."""
+    def __init__(self, maxsize=AI_STATE_CACHE):
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self._d = OrderedDict()
+        self.writer = WriteBehind("ai_state", _ai_state_apply, AI_STATE_FLUSH_MS, AI_STATE_FLUSH_MAX)
+        self.hits = self.misses = 0
+
+    async def get(self, uid) -> tuple:
+        uid = str(uid)
+        v = self._d.get(uid)
+        if v is not None:
+            self.hits += 1; self._d.move_to_end(uid)
+            return v
+        self.misses += 1
+        r = await _adb.fetchone("SELECT mode,extra FROM ai_state WHERE user_id=?", (uid,))
+        try: extra = json.loads(r["extra"] or "{}") if r else {}
+        except Exception: extra = {}
+        loaded = (r["mode"] if r else None, extra)
+        return self._put(uid, self._d.get(uid) or loaded)   # set() أثناء القراءة يغلب
+
+    def set(self, uid, mode, extra=None):
+        uid, extra = str(uid), extra or {}
+        self._put(uid, (mode, extra))
+        self.writer.put(uid, (mode, json.dumps(extra, ensure_ascii=False), int(time.time())))
+
+    def _put(self, uid, v):
+        self._d[uid] = v; self._d.move_to_end(uid)
+        while len(self._d) > self.maxsize:
+            old = next(iter(self._d))
+            if self.writer.pending(old) is not None: self._d.move_to_end(old); break   # غير مكتوب بعد
+            self._d.popitem(last=False)
+        return v
+
+    def __len__(self):
+        return len(self._d)
+
+_ai_state = AIStateStore()
+
+async def ai_set_mode_async(uid, mode, extra=None):
+    _ai_state.set(uid, mode, extra)
+
+async def ai_get_mode_async(uid):
+    return await _ai_state.get(uid)
+
+async def payments_create_async(uid, amount, provider="paylink", ref=None) -> str:
     ref = ref or payments_new_ref(uid)
-    with _db_lock:
-        _db().execute("INSERT OR REPLACE INTO payments (ref,user_id,amount,provider,status,created_at) VALUES (?,?,?,?,?,?)",
-                      (ref, str(uid), amount, provider, "pending", int(time.time())))
-        _db().commit()
+    await _adb.execute("INSERT OR REPLACE INTO payments (ref,user_id,amount,provider,status,created_at) VALUES (?,?,?,?,?,?)",
+                       (ref, str(uid), amount, provider, "pending", int(time.time())))
     return ref
 
-def payments_status(ref) -> str | None:
-    with _db_lock:
-        c = _db().cursor()
-        c.execute("SELECT status FROM payments WHERE ref=?", (ref,))
-        r = c.fetchone()
-        return r["status"] if r else None
+async def payments_status_async(ref) -> str | None:
+    r = await _adb.fetchone("SELECT status FROM payments WHERE ref=?", (ref,))
+    return r["status"] if r else None
 
-def payments_mark_paid_by_ref(ref, raw=None) -> bool:
-    with _db_lock:
-        c = _db().cursor()
-        c.execute("SELECT user_id,status FROM payments WHERE ref=?", (ref,))
-        r = c.fetchone()
-        if not r: return False
-        if r["status"] == "paid":
-            user_grant(r["user_id"]); return True
-        _db().execute("UPDATE payments SET status='paid', paid_at=?, raw=? WHERE ref=?",
-                      (int(time.time()), json.dumps(raw, ensure_ascii=False) if raw is not None else None, ref))
-        _db().commit()
-    user_grant(r["user_id"])
-    return True
+async def payments_list_async(limit=20) -> list[dict]:
+    return await _adb.fetchall("SELECT * FROM payments ORDER BY created_at DESC LIMIT ?", (limit,))
 
 # Paylink API
-_paylink_token = None
-_paylink_token_exp = 0
-async def paylink_auth_token():
-    global _paylink_token, _paylink_token_exp
-    now = time.time()
-    if _paylink_token and _paylink_token_exp > now + 10:
-        return _paylink_token
-    url = f"{PAYLINK_API_BASE}/auth"
-    payload = {"apiId": PAYLINK_API_ID, "secretKey": PAYLINK_API_SECRET, "persistToken": False}
-    async with aiohttp.ClientSession() as s:
-        async with s.post(url, json=payload, timeout=20) as r:
+PAYLINK_TOKEN_TTL = int(os.getenv("PAYLINK_TOKEN_TTL", str(9*60)) or "540")
+PAYLINK_REFRESH_AHEAD = int(os.getenv("PAYLINK_REFRESH_AHEAD","90") or "90")
+
+class PaylinkTokenManager:
+    """توكن Paylink: تحديث واحد مشترك للطلبات المتزامنة، تجديد مسبق بالخلفية قبل الانتهاء، وإعادة محاولة بتراجع."""
+    def __init__(self, ttl=PAYLINK_TOKEN_TTL, refresh_ahead=PAYLINK_REFRESH_AHEAD, attempts=3, backoff=0.5):
+        self.ttl, self.refresh_ahead, self.attempts, self.backoff = ttl, refresh_ahead, attempts, backoff
+        self._token, self._exp = None, 0.0
+        self._flight = SingleFlight()
+        self._task = None
+        self.refreshes = self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(PAYLINK_API_ID and PAYLINK_API_SECRET)
+
+    async def get(self) -> str:
+        if self._token and self._exp > time.time() + 10:
+            return self._token
+        return await self._flight.do("auth", self._refresh)
+
+    def invalidate(self):
+        self._token, self._exp = None, 0.0
+
+    async def _auth(self) -> str:
+        url = f"{PAYLINK_API_BASE}/auth"
+        payload = {"apiId": PAYLINK_API_ID, "secretKey": PAYLINK_API_SECRET, "persistToken": False}
+        async with _http.session().post(url, json=payload, timeout=_http.timeout("paylink")) as r:
             data = await r.json(content_type=None)
-    if "token" in data:
-        _paylink_token = data["token"]; _paylink_token_exp = now + 9*60; return _paylink_token
-    raise RuntimeError(f"paylink auth failed: {data}")
+        if isinstance(data, dict) and "token" in data:
+            return data["token"]
+        raise RuntimeError(f"paylink auth failed: {data}")
+
+    async def _refresh(self) -> str:
+        for attempt in range(1, self.attempts + 1):
+            try:
+                now = time.time()
+                self._token, self._exp = await self._auth(), now + self.ttl
+                self.refreshes += 1
+                self._schedule()
+                return self._token
+            except Exception as e:
+                self.failures += 1
+                log.warning("[paylink] auth try#%d: %s", attempt, e)
+                if attempt == self.attempts: raise
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+    def _schedule(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = asyncio.get_running_loop().create_task(self._refresh_later(max(1.0, self._exp - time.time() - self.refresh_ahead)))
+
+    async def _refresh_later(self, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            await self._flight.do("auth", self._refresh)
+        except Exception as e:
+            log.error("[paylink] background refresh failed: %s", e)
+
+    def start(self):
+        """يجهّز التوكن بالخلفية عند الإقلاع."""
+        if self.enabled and self._token is None:
+            self._task = asyncio.get_running_loop().create_task(self._refresh_later(0))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try: await self._task
+            except (asyncio.CancelledError, Exception): pass
+            self._task = None
+
+_paylink_tokens = PaylinkTokenManager()
+
+async def paylink_auth_token():
+    return await _paylink_tokens.get()
 
 async def paylink_create_invoice(order_number: str, amount: float, client_name: str):
-    token = await paylink_auth_token()
     url = f"{PAYLINK_API_BASE}/addInvoice"
     body = {
         "orderNumber": order_number,
@@ -484,10 +1271,13 @@ async def paylink_create_invoice(order_number: str, amount: float, client_name:
         "note": f"VIP via Telegram #{order_number}",
         "products": [{"title": "VIP Access (Lifetime)", "price": amount, "qty": 1, "isDigital": True}]
     }
-    headers = {"Authorization": f"Bearer {token}"}
-    async with aiohttp.ClientSession() as s:
-        async with s.post(url, json=body, headers=headers, timeout=30) as r:
+    for attempt in (1, 2):
+        headers = {"Authorization": f"Bearer {await paylink_auth_token()}"}
+        async with _http.session().post(url, json=body, headers=headers, timeout=_http.timeout("paylink")) as r:
+            if r.status == 401 and attempt == 1:
+                _paylink_tokens.invalidate(); continue  # توكن أُلغي من طرف Paylink
             data = await r.json(content_type=None)
+        break
     pay_url = data.get("url") or data.get("mobileUrl") or data.get("qrUrl")
     if not pay_url: raise RuntimeError(f"paylink addInvoice failed: {data}")
     return pay_url, data
@@ -505,28 +1295,172 @@ def md5_hex(s: str) -> str:
 
 async def http_head(url: str) -> int | None:
     try:
-        async with aiohttp.ClientSession() as s:
-            async with s.head(url, allow_redirects=True, timeout=15) as r:
-                return r.status
+        async with _http.session().head(url, allow_redirects=True, timeout=_http.timeout("head")) as r:
+            return r.status
     except Exception:
         return None
 
-def resolve_ip(host: str) -> str | None:
+DNS_MIN_TTL = int(os.getenv("DNS_MIN_TTL","30") or "30")
+DNS_MAX_TTL = int(os.getenv("DNS_MAX_TTL","3600") or "3600")
+DNS_NEG_TTL = int(os.getenv("DNS_NEG_TTL","60") or "60")
+DNS_TIMEOUT = float(os.getenv("DNS_TIMEOUT","5") or "5")
+WHOIS_CACHE_TTL = int(os.getenv("WHOIS_CACHE_TTL", str(24*3600)) or "0")
+
+class DnsCache:
+    """استعلامات A/AAAA/MX غير متزامنة مع كاش يحترم TTL السجلات (مقيّد بين DNS_MIN_TTL و DNS_MAX_TTL)."""
+    def __init__(self, size=5000):
+        self.cache = TTLCache(size)
+
+    async def _query(self, name: str, rtype: str) -> tuple[list[str], int]:
+        if dnsasync is not None:
+            try:
+                ans = await dnsasync.resolve(name, rtype, lifetime=DNS_TIMEOUT)
+            except (dnsresolver.NXDOMAIN, dnsresolver.NoAnswer):
+                return [], DNS_NEG_TTL
+            if rtype == "MX":
+                vals = [str(r.exchange).rstrip(".") for r in sorted(ans, key=lambda r: r.preference)]
+            else:
+                vals = [r.address for r in ans]
+            return vals, ans.rrset.ttl if ans.rrset is not None else DNS_MIN_TTL
+        if rtype == "MX":
+            raise RuntimeError("dnspython غير مثبت")
+        fam = socket.AF_INET6 if rtype == "AAAA" else socket.AF_INET
+        try:
+            infos = await asyncio.wait_for(asyncio.get_running_loop().getaddrinfo(name, None, family=fam), DNS_TIMEOUT)
+        except socket.gaierror:
+            return [], DNS_NEG_TTL
+        return list(dict.fromkeys(sa[0] for *_, sa in infos)), DNS_MIN_TTL
+
+    async def query(self, name: str, rtype: str = "A") -> list[str]:
+        """يرجع قائمة (فارغة = لا يوجد سجل). أخطاء الشبكة/المهلة تُرفع ولا تُخزّن."""
+        key = (name.lower().rstrip("."), rtype)
+        vals = self.cache.get(key)
+        if vals is not None: return vals
+        with span("dns"):
+            vals, ttl = await self._query(key[0], rtype)
+        self.cache.set(key, vals, ttl=min(max(ttl, DNS_MIN_TTL), DNS_MAX_TTL))
+        return vals
+
+_dns = DnsCache()
+
+async def resolve_ip(host: str) -> str | None:
+    """IPv4 أولاً ثم IPv6 (مثل السلوك السابق)."""
     try:
-        infos = socket.getaddrinfo(host, None)
-        for _,_,_,_,sa in infos:
-            ip = sa[0]
-            if ":" not in ip: return ip
-        return infos[0][4][0] if infos else None
-    except Exception:
-        return None
+        socket.inet_pton(socket.AF_INET6 if ":" in host else socket.AF_INET, host)
+        return host
+    except OSError:
+        pass
+    for rtype in ("A", "AAAA"):
+        try:
+            vals = await _dns.query(host, rtype)
+        except Exception:
+            continue
+        if vals: return vals[0]
+    return None
+
+GEO_DB_PATH = (os.getenv("GEO_DB_PATH") or "").strip()  # CSV نطاقات IP (محلي) — ip-api فقط عند عدم التطابق
+
+class GeoIndex:
+    """فهرس نطاقات IP في الذاكرة: مصفوفات مرتبة (بداية/نهاية/رقم سجل) + بحث ثنائي.
+
+    CSV بترويسة: إما network (CIDR) أو start/end (نص IP أو رقم)، والباقي بأسماء حقول ip-api
+    (country, regionName, city, zip, lat, lon, timezone, isp, org, as) أو مرادفاتها الشائعة.
+    """
+    FIELDS = ("country", "regionName", "city", "zip", "lat", "lon", "timezone", "isp", "org", "as")
+    ALIASES = {"region": "regionName", "region_name": "regionName", "country_name": "country", "latitude": "lat",
+               "longitude": "lon", "postal_code": "zip", "time_zone": "timezone", "asn": "as",
+               "start_ip": "start", "ip_from": "start", "end_ip": "end", "ip_to": "end"}
+
+    def __init__(self):
+        self.v4 = (array("I"), array("I"), array("I"))   # starts, ends, record idx
+        self.v6 = ([], [], array("I"))                   # أعداد 128-بت لا تناسب array
+        self.records = []
+
+    def __len__(self):
+        return len(self.v4[0]) + len(self.v6[0])
+
+    def nbytes(self) -> int:
+        n = sum(a.itemsize * len(a) for a in (*self.v4, self.v6[2]))
+        n += sum(os.sys.getsizeof(x) for x in self.v6[0]) + sum(os.sys.getsizeof(x) for x in self.v6[1])
+        return n + sum(os.sys.getsizeof(r) + sum(os.sys.getsizeof(v) for v in r) for r in self.records)
+
+    @staticmethod
+    def _ip_int(v: str):
+        v = v.strip()
+        for fam, ver in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
+            try: return int.from_bytes(socket.inet_pton(fam, v), "big"), ver
+            except OSError: pass
+        if v.isdigit(): n = int(v); return n, (4 if n < 2**32 else 6)
+        raise ValueError(f"not an IP: {v!r}")
+
+    @classmethod
+    def load_csv(cls, path: str) -> "GeoIndex":
+        idx, recs, rows4, rows6 = cls(), {}, [], []
+        with open(path, newline="", encoding="utf-8") as f:
+            rd = csv.DictReader(f)
+            cols = {c: cls.ALIASES.get(c.strip(), c.strip()) for c in rd.fieldnames or []}
+            for row in rd:
+                row = {cols[k]: (v or "").strip() for k, v in row.items() if k in cols}
+                try:
+                    if row.get("network"):
+                        net = ipaddress.ip_network(row["network"], strict=False)
+                        lo, hi, ver = int(net.network_address), int(net.broadcast_address), net.version
+                    else:
+                        (lo, ver), (hi, _) = cls._ip_int(row["start"]), cls._ip_int(row["end"])
+                except (KeyError, ValueError):
+                    continue
+                rec = []
+                for k in cls.FIELDS:
+                    v = row.get(k) or None
+                    if v is not None and k in ("lat", "lon"):
+                        try: v = float(v)
+                        except ValueError: v = None
+                    rec.append(v)
+                rec = tuple(rec)
+                ri = recs.setdefault(rec, len(recs))
+                (rows4 if ver == 4 else rows6).append((lo, hi, ri))
+        idx.records = list(recs)
+        for rows, (starts, ends, ridx) in ((rows4, idx.v4), (rows6, idx.v6)):
+            rows.sort()
+            for lo, hi, ri in rows:
+                starts.append(lo); ends.append(hi); ridx.append(ri)
+        return idx
+
+    def lookup(self, query: str) -> dict | None:
+        try:
+            n, ver = self._ip_int(query)
+        except ValueError:
+            return None
+        starts, ends, ridx = self.v4 if ver == 4 else self.v6
+        i = bisect_right(starts, n) - 1
+        if i < 0 or n > ends[i]: return None
+        d = {k: v for k, v in zip(self.FIELDS, self.records[ridx[i]]) if v is not None}
+        d.update(status="success", query=query)
+        return d
+
+_geo_index: GeoIndex | None = None
+_geo_task: asyncio.Task | None = None
+
+async def load_geo_index():
+    global _geo_index
+    if not GEO_DB_PATH: return
+    try:
+        t = time.perf_counter()
+        _geo_index = await asyncio.to_thread(GeoIndex.load_csv, GEO_DB_PATH)
+        log.info("[geo] %d ranges from %s in %.1fs", len(_geo_index), GEO_DB_PATH, time.perf_counter() - t)
+    except Exception as e:
+        log.error("[geo] load %s failed: %s", GEO_DB_PATH, e)
 
 async def fetch_geo(query: str) -> dict | None:
-    url = f"http://ip-api.com/json/{query}?fields=status,message,country,regionName,city,isp,org,as,query,lat,lon,timezone,zip,reverse"
+    if _geo_index is not None:
+        hit = _geo_index.lookup(query)
+        if hit is not None: return hit
+    if not upstream_allow("ipapi"):
+        return {"status":"fail","message":"rate limited, try again shortly"}
+    url = f"{IPAPI_BASE}/json/{query}?fields=status,message,country,regionName,city,isp,org,as,query,lat,lon,timezone,zip,reverse"
     try:
-        async with aiohttp.ClientSession() as s:
-            async with s.get(url, timeout=15) as r:
-                return await r.json(content_type=None)
+        async with _http.session().get(url, timeout=_http.timeout("ipapi")) as r:
+            return await r.json(content_type=None)
     except Exception:
         return {"status":"fail","message":"network error"}
 
@@ -548,11 +1482,11 @@ def fmt_geo(data: dict) -> str:
 async def urlscan_lookup(u: str) -> str:
     if not URLSCAN_API_KEY:
         return "ℹ️ ضع URLSCAN_API_KEY لتفعيل الفحص."
+    if not upstream_allow("urlscan"): return UPSTREAM_BUSY_TXT
     try:
         headers = {"API-Key": URLSCAN_API_KEY, "Content-Type": "application/json"}
-        async with aiohttp.ClientSession() as s:
-            async with s.post("https://urlscan.io/api/v1/scan/", headers=headers, json={"url": u, "visibility":"unlisted"}, timeout=30) as r:
-                data = await r.json(content_type=None)
+        async with _http.session().post(f"{URLSCAN_API_BASE}/scan/", headers=headers, json={"url": u, "visibility":"unlisted"}, timeout=_http.timeout("urlscan")) as r:
+            data = await r.json(content_type=None)
         out = []
         if "result" in data: out.append(f"urlscan: {data['result']}")
         if "message" in data: out.append(f"msg: {data['message']}")
@@ -563,11 +1497,11 @@ async def urlscan_lookup(u: str) -> str:
 async def kickbox_lookup(email: str) -> str:
     if not KICKBOX_API_KEY:
         return "ℹ️ ضع KICKBOX_API_KEY لتفعيل فحص الإيميل."
+    if not upstream_allow("kickbox"): return UPSTREAM_BUSY_TXT
     try:
         params = {"email": email, "apikey": KICKBOX_API_KEY}
-        async with aiohttp.ClientSession() as s:
-            async with s.get("https://api.kickbox.com/v2/verify", params=params, timeout=20) as r:
-                data = await r.json(content_type=None)
+        async with _http.session().get(f"{KICKBOX_API_BASE}/verify", params=params, timeout=_http.timeout("kickbox")) as r:
+            data = await r.json(content_type=None)
         return f"Kickbox: result={data.get('result')} reason={data.get('reason')}"
     except Exception as e:
         return f"kickbox error: {e}"
@@ -589,106 +1523,448 @@ def whois_domain(domain: str) -> dict | None:
     except Exception as e:
         return {"error": f"whois error: {e}"}
 
+_whois_cache = TTLCache(2000, ttl=WHOIS_CACHE_TTL)
+
+async def whois_domain_async(domain: str) -> dict | None:
+    """WHOIS في ثريد خارج الحلقة مع كاش طويل (الأخطاء تُخزّن لمدة DNS_NEG_TTL فقط)."""
+    key = domain.lower().rstrip(".")
+    w = _whois_cache.get(key)
+    if w is not None: return w
+    with span("whois"):
+        w = await asyncio.to_thread(whois_domain, key)
+    if w is not None and WHOIS_CACHE_TTL:
+        _whois_cache.set(key, w, ttl=DNS_NEG_TTL if w.get("error") else None)
+    return w
+
+# probes: فحوص مستقلة تعمل بالتوازي تحت مهلة إجمالية واحدة + مهلة لكل فحص
+OSINT_DEADLINE = float(os.getenv("OSINT_DEADLINE","12") or "12")
+PROBE_TIMEOUTS = {
+    name: float(os.getenv(f"PROBE_TIMEOUT_{name.upper()}", str(default)) or default)
+    for name, default in {"mx": 5, "gravatar": 6, "whois": 10, "geo": 8, "head": 8, "urlscan": 10}.items()
+}
+PROBE_TIMEOUT_TXT = "⏱️ انتهت المهلة"
+UPSTREAM_BUSY_TXT = "⏳ الخدمة مشغولة حالياً، حاول بعد قليل."
+
+async def run_probes(probes: dict, deadline: float = OSINT_DEADLINE) -> dict:
+    """probes: name -> coroutine. يرجع name -> (status, value) حيث status: ok / timeout / error."""
+    tasks = {name: asyncio.ensure_future(asyncio.wait_for(coro, min(PROBE_TIMEOUTS.get(name, deadline), deadline)))
+             for name, coro in probes.items()}
+    await asyncio.wait(tasks.values(), timeout=deadline)
+    out = {}
+    for name, t in tasks.items():
+        if not t.done():
+            t.cancel(); out[name] = ("timeout", None); continue
+        e = t.exception()
+        if isinstance(e, asyncio.TimeoutError): out[name] = ("timeout", None)
+        elif e is not None:
+            log.warning("[probe] %s: %s", name, e); out[name] = ("error", e)
+        else: out[name] = ("ok", t.result())
+    return out
+
+def probe_text(res: dict, name: str, fmt=str) -> str:
+    st, v = res[name]
+    if st == "timeout": return PROBE_TIMEOUT_TXT
+    if st == "error": return f"⚠️ {v}"
+    return fmt(v)
+
+async def _probe_mx(domain: str) -> str:
+    if not dnsasync: return "dnspython غير مثبت"
+    try:
+        mx_hosts = await _dns.query(domain, "MX")
+        return ", ".join(mx_hosts[:5]) if mx_hosts else "لا يوجد"
+    except dnsexception.DNSException:
+        return "لا يوجد (فشل الاستعلام)"
+
+async def _probe_geo(host: str, fail_txt: str) -> str:
+    ip = await resolve_ip(host)
+    return fmt_geo(await fetch_geo(ip)) if ip else fail_txt
+
+def _fmt_whois(w) -> str:
+    return "WHOIS: غير متاح" if not w else (f"WHOIS: {w['error']}" if w.get("error") else f"WHOIS:\n- Registrar: {w.get('registrar')}\n- Created: {w.get('creation_date')}\n- Expires: {w.get('expiration_date')}")
+
 async def osint_email(email: str) -> str:
     if not is_valid_email(email):
         return "⚠️ صيغة الإيميل غير صحيحة."
     local, domain = email.split("@",1)
-    # MX
-    if dnsresolver:
-        try:
-            answers = dnsresolver.resolve(domain,"MX")
-            mx_hosts = [str(r.exchange).rstrip(".") for r in answers]
-            mx_txt = ", ".join(mx_hosts[:5]) if mx_hosts else "لا يوجد"
-        except dnsexception.DNSException:
-            mx_txt = "لا يوجد (فشل الاستعلام)"
-    else:
-        mx_txt = "dnspython غير مثبت"
-    # gravatar
-    g_url = f"https://www.gravatar.com/avatar/{md5_hex(email)}?d=404"
-    g_st = await http_head(g_url)
-    grav = "✅ موجود" if g_st and 200 <= g_st < 300 else "❌ غير موجود"
-    # whois
-    w = whois_domain(domain)
-    w_txt = "WHOIS: غير متاح" if not w else (f"WHOIS: {w['error']}" if w.get("error") else f"WHOIS:\n- Registrar: {w.get('registrar')}\n- Created: {w.get('creation_date')}\n- Expires: {w.get('expiration_date')}")
-    # geo
-    ip = resolve_ip(domain)
-    geo_txt = fmt_geo(await fetch_geo(ip)) if ip else "⚠️ تعذّر حلّ IP للدومين."
+    res = await run_probes({
+        "mx": _probe_mx(domain),
+        "gravatar": http_head(f"https://www.gravatar.com/avatar/{md5_hex(email)}?d=404"),
+        "whois": whois_domain_async(domain),
+        "geo": _probe_geo(domain, "⚠️ تعذّر حلّ IP للدومين."),
+    })
+    mx_txt = probe_text(res, "mx")
+    grav = probe_text(res, "gravatar", lambda st: "✅ موجود" if st and 200 <= st < 300 else "❌ غير موجود")
+    w_txt = probe_text(res, "whois", _fmt_whois) if res["whois"][0] == "ok" else f"WHOIS: {probe_text(res, 'whois')}"
+    geo_txt = probe_text(res, "geo")
     return "\n".join([f"📧 {email}", f"📮 MX: {mx_txt}", f"🖼️ Gravatar: {grav}", w_txt, "\n"+geo_txt])
 
 async def link_scan(u: str) -> str:
     if not re.search(r"https?://", u or ""):
         return "⚠️ أرسل رابط يبدأ بـ http:// أو https://"
     host = re.sub(r"^https?://", "", u).split("/")[0]
-    issues = []
-    st = await http_head(u); issues.append(f"🔎 HTTP: {st if st is not None else 'n/a'}")
+    res = await run_probes({
+        "head": http_head(u),
+        "urlscan": urlscan_lookup(u),
+        "geo": _probe_geo(host, "⚠️ تعذّر حلّ IP."),
+    })
+    issues = [f"🔎 HTTP: {probe_text(res, 'head', lambda st: st if st is not None else 'n/a')}"]
     if not u.startswith("https://"): issues.append("❗️ الرابط بدون HTTPS")
-    try:
-        us = await urlscan_lookup(u); issues.append(us)
-    except Exception:
-        pass
-    ip = resolve_ip(host)
-    geo_txt = fmt_geo(await fetch_geo(ip)) if ip else "⚠️ تعذّر حلّ IP."
+    if res["urlscan"][0] != "error": issues.append(probe_text(res, "urlscan") if res["urlscan"][0] == "ok" else f"urlscan: {PROBE_TIMEOUT_TXT}")
+    geo_txt = probe_text(res, "geo")
     return f"🔗 <code>{_escape(u)}</code>\nالمضيف: <code>{_escape(host)}</code>\n" + "\n".join(issues) + f"\n\n{geo_txt}"
 
 # ------------- AI -------------
 def contains_arabic(text: str) -> bool:
     return bool(re.search(r"[\u0600-\u06FF]", text))
 
-def ai_chat_reply(text: str) -> str:
-    if not AI_ENABLED or OpenAI is None:
-        return "🧠 الذكاء الاصطناعي غير مفعّل."
-    _ensure_openai()
-    msgs = [
-        {"role":"system","content":"أجب بإيجاز وبأسلوب مهني."},
-        {"role":"user","content": text}
-    ]
-    try:
-        r = _openai_client.chat.completions.create(model=OPENAI_CHAT_MODEL, messages=msgs, temperature=0.6)
-        return (r.choices[0].message.content or "").strip()
-    except Exception as e:
-        log.error("[ai-chat] %s", e)
-        return "⚠️ تعذّر الرد حالياً."
+AI_DISABLED_TEXT = "🧠 الذكاء الاصطناعي غير مفعّل."
+
+# mode -> (system prompt, temperature, fallback عند الفشل)
+AI_MODES = {
+    "ai_chat":   ("أجب بإيجاز وبأسلوب مهني.", 0.6, "⚠️ تعذّر الرد حالياً."),
+    "writer":    ("أنت كاتب إعلانات محترف. اكتب نصًا تسويقيًا واضحًا ومقنعًا مع CTA واستخدام عناوين قصيرة.", 0.7, "⚠️ تعذّر التوليد حالياً."),
+    "translate": ("Translate accurately while preserving meaning.", 0.0, "⚠️ تعذّر الترجمة حالياً."),
+}
+
+M_AI_TOKENS = METRICS.counter("bot_ai_tokens_total", "Tokens reported by the AI provider", ("kind",))
+M_AI_PROMPT = METRICS.histogram("bot_ai_prompt_tokens", "Estimated prompt tokens per AI request", ("mode",),
+                                buckets=(100, 250, 500, 1000, 2000, 4000, 8000))
+M_AI_FOLDS = METRICS.counter("bot_ai_chat_folds_total", "Chat history folds into the running summary", ("result",))
+
+def tok_est(s: str) -> int:
+    """تقدير تقريبي للتوكنات (~3 أحرف/توكن، متحفظ مع العربية) بدون tokenizer."""
+    return len(s) // 3 + 1
+
+def _turns_tokens(turns) -> int:
+    return sum(tok_est(u) + tok_est(a) for u, a in turns)
+
+def chat_messages(system: str, chat: dict, text: str) -> list:
+    """system ثابت ← الملخص ← الأدوار الأخيرة ← الرسالة الجديدة.
+    البادئة لا تتغير بين الطيّات فيصيب كاش البادئة لدى المزوّد؛ والحجم محدود بالسقفين مهما طالت الجلسة."""
+    turns, used = [], 0
+    for u, a in reversed(chat.get("h") or []):   # الطي يتم بالخلفية؛ حتى يكتمل نرسل ما يسعه السقف فقط
+        used += tok_est(u) + tok_est(a)
+        if used > AI_CHAT_HISTORY_TOKENS: break
+        turns.append((u, a))
+    msgs = [{"role":"system","content":system}]
+    if chat.get("s"):
+        msgs.append({"role":"system","content":"ملخص ما سبق من المحادثة:\n" + chat["s"][:AI_CHAT_SUMMARY_TOKENS * 3]})
+    for u, a in reversed(turns):
+        msgs += [{"role":"user","content":u}, {"role":"assistant","content":a}]
+    msgs.append({"role":"user","content":text})
+    return msgs
+
+def ai_request(mode: str, text: str, chat: dict | None = None) -> tuple[list, float, str]:
+    """يرجع (messages, temperature, header) — الـheader يظهر فوراً قبل أول توكن. chat = سجل ai_chat من ai_state."""
+    system, temperature, _ = AI_MODES[mode]
+    header = ""
+    if mode == "translate":
+        src_ar = contains_arabic(text)
+        text = f"Source:\n{text}\n\nTranslate to {'English' if src_ar else 'Arabic'} only."
+        header = "🇦🇪 AR → 🇬🇧 EN\n\n" if src_ar else "🇬🇧 EN → 🇦🇪 AR\n\n"
+    if chat is not None:
+        return chat_messages(system, chat, text), temperature, header
+    return [{"role":"system","content":system},{"role":"user","content":text}], temperature, header
+
+class AIResponseCache:
+    """كاش ردود بمفتاح sha256(mode, model, system, input مطبّع): ذاكرة LRU+TTL ثم جدول ai_cache."""
+    def __init__(self, modes, size, ttl):
+        self.modes, self.ttl = modes, ttl
+        self.mem = TTLCache(size, ttl=ttl)
+        self.mem_hits = self.db_hits = self.misses = self.stores = 0
+
+    def enabled(self, mode: str) -> bool:
+        return mode in self.modes and self.ttl > 0
+
+    @staticmethod
+    def key(mode: str, messages: list) -> str:
+        import unicodedata
+        system = next((m["content"] for m in messages if m["role"] == "system"), "")
+        user = unicodedata.normalize("NFC", " ".join(messages[-1]["content"].split()))
+        raw = json.dumps([mode, OPENAI_CHAT_MODEL, system, user], ensure_ascii=False)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        v = self.mem.get(key)
+        if v is not None:
+            self.mem_hits += 1; return v
+        r = await _adb.fetchone("SELECT response FROM ai_cache WHERE key=? AND expires_at>?", (key, int(time.time())))
+        if r:
+            self.db_hits += 1; self.mem.set(key, r["response"]); return r["response"]
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, mode: str, text: str):
+        if not text: return
+        now = int(time.time())
+        self.mem.set(key, text); self.stores += 1
+        await _adb.execute("INSERT OR REPLACE INTO ai_cache (key,mode,response,created_at,expires_at) VALUES (?,?,?,?,?)",
+                           (key, mode, text, now, now + self.ttl), wait=False)
 
-async def ai_write(prompt: str) -> str:
-    if not AI_ENABLED or OpenAI is None:
-        return "🧠 الذكاء الاصطناعي غير مفعّل."
+    async def purge_expired(self):
+        await _adb.execute("DELETE FROM ai_cache WHERE expires_at<=?", (int(time.time()),), wait=False)
+
+    def stats(self) -> str:
+        total = self.mem_hits + self.db_hits + self.misses
+        ratio = (self.mem_hits + self.db_hits) / total if total else 0
+        return (f"ai_cache modes={','.join(sorted(self.modes)) or '-'} mem_hits={self.mem_hits} db_hits={self.db_hits} "
+                f"misses={self.misses} stores={self.stores} hit_ratio={ratio:.2f} mem_size={len(self.mem)}")
+
+_ai_cache = AIResponseCache(AI_CACHE_MODES, AI_CACHE_SIZE, AI_CACHE_TTL)
+
+async def ai_stream(messages: list, temperature: float, max_tokens: int | None = None):
+    """يبث أجزاء الرد من العميل غير المتزامن بدون حجز حلقة الأحداث."""
     _ensure_openai()
-    sys = "أنت كاتب إعلانات محترف. اكتب نصًا تسويقيًا واضحًا ومقنعًا مع CTA واستخدام عناوين قصيرة."
+    if not upstream_allow("openai"): raise UpstreamLimited("openai")
+    t0 = time.perf_counter()
     try:
-        r = _openai_client.chat.completions.create(
-            model=OPENAI_CHAT_MODEL,
-            messages=[{"role":"system","content":sys},{"role":"user","content":prompt}],
-            temperature=0.7
+        stream = await _openai_client.chat.completions.create(
+            model=OPENAI_CHAT_MODEL, messages=messages, temperature=temperature, stream=True,
+            stream_options={"include_usage": True}, **({"max_tokens": max_tokens} if max_tokens else {})
         )
-        return (r.choices[0].message.content or "").strip()
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                u = chunk.usage; details = getattr(u, "prompt_tokens_details", None)
+                M_AI_TOKENS.inc("prompt", n=u.prompt_tokens or 0); M_AI_TOKENS.inc("completion", n=u.completion_tokens or 0)
+                M_AI_TOKENS.inc("cached", n=getattr(details, "cached_tokens", 0) or 0)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except Exception as e:
+        M_UPSTREAM_ERR.inc("openai", type(e).__name__); raise
+    finally:
+        dt = time.perf_counter() - t0
+        M_UPSTREAM.observe(dt, "openai"); trace_add("openai", dt)
+
+# سجل ai_chat: ai_state.extra = {"s": ملخص الأدوار المطوية, "h": [[user, assistant], ...]}
+AI_SUMMARY_PROMPT = "لخّص المحادثة التالية في نقاط قصيرة وبلغتها: الحقائق والطلبات والتفضيلات التي قد يحتاجها الرد التالي فقط."
+_chat_folding = set()
+
+async def chat_record(uid, text: str, reply: str):
+    """يضيف الدور إلى السجل؛ عند تجاوز السقف يطوي الأقدم في الملخص خارج مسار الرد."""
+    if AI_CHAT_HISTORY_TOKENS <= 0: return
+    uid = str(uid)
+    mode, extra = await ai_get_mode_async(uid)
+    if mode != "ai_chat": return   # أُنهيت الجلسة أثناء الرد
+    h = (extra.get("h") or []) + [[text, reply]]
+    await ai_set_mode_async(uid, mode, {**extra, "h": h})
+    if _turns_tokens(h) > AI_CHAT_HISTORY_TOKENS and uid not in _chat_folding:
+        _chat_folding.add(uid); spawn(_chat_fold(uid), f"chat-fold-{uid}")
+
+async def _chat_summarize(summary: str, turns: list) -> str:
+    transcript = "\n".join(f"U: {u}\nA: {a}" for u, a in turns)
+    src = (f"الملخص السابق:\n{summary}\n\n" if summary else "") + f"المحادثة:\n{transcript}"
+    limit = AI_CHAT_SUMMARY_TOKENS * 3
+    try:
+        out = "".join([p async for p in ai_stream([{"role":"system","content":AI_SUMMARY_PROMPT},{"role":"user","content":src}],
+                                                  0.2, max_tokens=AI_CHAT_SUMMARY_TOKENS)]).strip()
     except Exception as e:
-        log.error("[ai-write] %s", e)
-        return "⚠️ تعذّر التوليد حالياً."
+        log.warning("[ai-chat] summarize: %s", e); out = ""
+    if out: return out[:limit]
+    M_AI_FOLDS.inc("fallback")
+    return (summary + "\n" + transcript)[-limit:]   # بدون المزوّد: نحتفظ بالأحدث نصاً
 
-async def ai_auto_translate(text: str) -> str:
-    """إذا عربي -> إنجليزي، وإلا إنجليزي -> عربي. ويُظهر الاتجاه بوضوح."""
-    if not AI_ENABLED or OpenAI is None:
-        return "🧠 الذكاء الاصطناعي غير مفعّل."
-    _ensure_openai()
-    src_ar = contains_arabic(text)
-    target = "English" if src_ar else "Arabic"
+async def _chat_fold(uid: str):
+    """يطوي أقدم الأدوار حتى يبقى السجل ≤ نصف السقف: طيّات قليلة بدفعات = بادئة مستقرة لفترة أطول."""
     try:
-        r = _openai_client.chat.completions.create(
-            model=OPENAI_CHAT_MODEL,
-            messages=[{"role":"system","content":"Translate accurately while preserving meaning."},
-                      {"role":"user","content": f"Source:\n{text}\n\nTranslate to {target} only."}],
-            temperature=0.0
-        )
-        out = (r.choices[0].message.content or "").strip()
-        if src_ar:
-            return f"🇦🇪 AR → 🇬🇧 EN\n\n{out}"
-        else:
-            return f"🇬🇧 EN → 🇦🇪 AR\n\n{out}"
+        _, extra = await ai_get_mode_async(uid)
+        h = extra.get("h") or []
+        keep = len(h)
+        while keep > 1 and _turns_tokens(h[len(h) - keep:]) > AI_CHAT_HISTORY_TOKENS // 2: keep -= 1
+        old = h[:len(h) - keep]
+        if not old: return
+        summary = await _chat_summarize(extra.get("s", ""), old)
+        mode, extra = await ai_get_mode_async(uid)   # الحالة قد تتغير أثناء التلخيص
+        h = extra.get("h") or []
+        if mode != "ai_chat" or h[:len(old)] != old:
+            M_AI_FOLDS.inc("stale"); return
+        await ai_set_mode_async(uid, mode, {**extra, "s": summary, "h": h[len(old):]})
+        M_AI_FOLDS.inc("ok")
     except Exception as e:
-        log.error("[ai-translate] %s", e)
-        return "⚠️ تعذّر الترجمة حالياً."
+        log.warning("[ai-chat] fold: %s", e)
+    finally:
+        _chat_folding.discard(uid)
+
+TG_MAX_TEXT = 4096
+
+async def _edit_text(msg, text, kb=None, parse_mode=None, final=False, tries=3):
+    """التعديلات الوسيطة تُتخطّى عند flood-wait؛ التعديل النهائي ينتظر ويعيد المحاولة (حتى tries مرات)."""
+    try:
+        await msg.edit_text(text, reply_markup=kb, parse_mode=parse_mode, disable_web_page_preview=True)
+    except RetryAfter as e:
+        if not final: return
+        if tries <= 1:
+            log.warning("[ai-stream] final edit still flood-limited: %s", e); return
+        await asyncio.sleep(e.retry_after)
+        await _edit_text(msg, text, kb=kb, parse_mode=parse_mode, final=True, tries=tries - 1)
+    except BadRequest as e:
+        err = str(e).lower()
+        if "not modified" in err: return
+        if parse_mode and "parse" in err:
+            await _edit_text(msg, text, kb=kb, final=final, tries=tries); return
+        log.warning("[ai-stream] edit: %s", e)
+
+async def ai_reply_streaming(message, mode: str, text: str, kb=None, parse_mode=None, chat=None) -> str | None:
+    """يرسل رسالة مؤقتة ثم يحدّثها تدريجياً (بحد أدنى AI_STREAM_EDIT_INTERVAL بين التعديلات). يرجع نص الرد إن اكتمل."""
+    if not AI_ENABLED or AsyncOpenAI is None:
+        await message.reply_text(AI_DISABLED_TEXT, reply_markup=kb); return
+    messages, temperature, header = ai_request(mode, text, chat)
+    M_AI_PROMPT.observe(sum(tok_est(m["content"]) for m in messages), mode)
+    key = _ai_cache.key(mode, messages) if _ai_cache.enabled(mode) and len(messages) == 2 else None   # الكاش لرسالة بلا سياق فقط
+    cached = await _ai_cache.get(key) if key else None
+    sent, buf, failed = None, cached or "", False
+    if cached is None:
+        sent = await message.reply_text(header + "…")
+        shown, last = "", time.monotonic()
+        try:
+            async for piece in ai_stream(messages, temperature):
+                buf += piece
+                now = time.monotonic()
+                if now - last >= AI_STREAM_EDIT_INTERVAL:
+                    preview = (header + buf).rstrip()[:TG_MAX_TEXT - 2] + " ▌"
+                    if preview != shown:
+                        await _edit_text(sent, preview); shown = preview
+                    last = time.monotonic()
+            if key: await _ai_cache.put(key, mode, buf.strip())
+        except Exception as e:
+            log.error("[ai-%s] %s", mode, e)
+            if not buf.strip():
+                await _edit_text(sent, AI_MODES[mode][2], kb=kb, final=True); return
+            failed = True
+    full = header + buf.strip()
+    parts = [full[i:i+TG_MAX_TEXT] for i in range(0, len(full), TG_MAX_TEXT)] or [full]
+    first_kb = kb if len(parts) == 1 else None
+    if sent is not None:
+        await _edit_text(sent, parts[0], kb=first_kb, parse_mode=parse_mode, final=True)
+    else:
+        try:
+            await message.reply_text(parts[0], reply_markup=first_kb, parse_mode=parse_mode)
+        except BadRequest:
+            await message.reply_text(parts[0], reply_markup=first_kb)
+    for i, part in enumerate(parts[1:], start=2):
+        await message.reply_text(part, reply_markup=kb if i == len(parts) else None)
+    return None if failed else buf.strip()   # الرد المقطوع يُعرض لكن لا يدخل سجل المحادثة
+
+# ------------- Rate limiting -------------
+# الميزانيات بصيغة "N/ثواني" (مثلاً 8/60 = 8 طلبات في الدقيقة مع سماح بدفعة حتى 8)؛ 0 أو فارغ = بلا حد
+RL_USER = {c: os.getenv(f"RL_USER_{c.upper()}", d) for c, d in {"ai": "8/60", "osint": "4/60"}.items()}
+RL_UPSTREAM = {n: os.getenv(f"RL_UPSTREAM_{n.upper()}", d) for n, d in
+               {"openai": "120/60", "urlscan": "30/60", "kickbox": "30/60", "ipapi": "40/60"}.items()}
+# mode -> فئة ميزانية المستخدم. دلاء الخدمات الخارجية تُستهلك عند الاستدعاء الفعلي (upstream_allow)، لا عند الإرسال
+RATE_CLASSES = {"ai_chat": "ai", "writer": "ai", "translate": "ai", "link_scan": "osint", "email_check": "osint", "geo_ip": "osint"}
+
+class TokenBucket:
+    """token bucket في الذاكرة لكل مفتاح (مستخدم) أو مفتاح واحد (خدمة). الحالة (tokens, last) في TTLCache محدود."""
+    def __init__(self, spec: str, maxkeys=50000):
+        n, _, w = (spec or "0").partition("/")
+        self.capacity = float(n or 0); self.window = float(w or 1)
+        self.rate = self.capacity / self.window if self.capacity else 0.0
+        self._b = TTLCache(maxkeys, ttl=self.window)   # بعد window يكون الدلو ممتلئاً أصلاً
+        self.allowed = self.limited = 0
+
+    def _tokens(self, key, now):
+        tokens, last = self._b.get(key) or (self.capacity, now)
+        return min(self.capacity, tokens + (now - last) * self.rate)
+
+    def wait(self, key, now) -> float:
+        """0 إن توفّر رمز، وإلا الثواني حتى توفّره."""
+        if not self.capacity: return 0.0
+        t = self._tokens(key, now)
+        return 0.0 if t >= 1 else (1 - t) / self.rate
+
+    def take(self, key, now):
+        if self.capacity: self._b.set(key, (self._tokens(key, now) - 1, now))
+        self.allowed += 1
+
+    def stats(self) -> str:
+        lim = f"{self.capacity:g}/{self.window:g}s" if self.capacity else "off"
+        return f"{lim} allowed={self.allowed} limited={self.limited} keys={len(self._b)}"
+
+_rl_user = {c: TokenBucket(spec) for c, spec in RL_USER.items()}
+_rl_upstream = {n: TokenBucket(spec, maxkeys=1) for n, spec in RL_UPSTREAM.items()}
+_rl_notified = TTLCache(50000)   # رسالة "تمهّل" واحدة لكل مستخدم خلال فترة الانتظار
+
+class UpstreamLimited(Exception):
+    """دلو الخدمة الخارجية فارغ: الطلب لم يُرسل."""
+
+def rate_check(uid: int, mode: str) -> float:
+    """يأخذ رمزاً من دلو المستخدم لفئة الـ mode، أو يعيد ثواني الانتظار دون استهلاك شيء. المالك معفى."""
+    b = _rl_user.get(RATE_CLASSES.get(mode))
+    if b is None or uid == OWNER_ID: return 0.0
+    now = time.monotonic()
+    wait = b.wait(uid, now)
+    if wait > 0:
+        b.limited += 1; return wait
+    b.take(uid, now)
+    return 0.0
+
+def upstream_allow(name: str) -> bool:
+    """رمز من دلو الخدمة لحظة الاستدعاء الشبكي فقط؛ ما يُجاب محلياً (GeoIndex، الكاش) لا يستهلك شيئاً."""
+    b = _rl_upstream.get(name)
+    if b is None: return True
+    now = time.monotonic()
+    if b.wait(name, now) > 0:
+        b.limited += 1; return False
+    b.take(name, now)
+    return True
+
+def rate_stats() -> str:
+    return "\n".join([f"user:{c} {b.stats()}" for c, b in _rl_user.items()] +
+                     [f"upstream:{n} {b.stats()}" for n, b in _rl_upstream.items()])
+
+# ------------- Work pools -------------
+# حد تزامن مستقل لكل فئة عمل، وطابور انتظار محدود لكل فئة (0 = بلا حد). PTB يحجز مقعده العام قبل أي pool،
+# فالمنتظر في pool يحجز مقعداً عاماً أيضاً: بعد امتلاء الطابور يُرد "مشغول" فوراً ويتحرر المقعد،
+# وبذلك لا تحجز أدوات الشبكة البطيئة أكثر من limit + queue من UPDATES_MAX_INFLIGHT وتبقى القوائم سريعة
+POOL_LIMITS = {n: int(os.getenv(f"POOL_{n.upper()}", str(d)) or d) for n, d in {"ui": 64, "ai": 16, "osint": 32, "pay": 4}.items()}
+POOL_QUEUES = {n: int(os.getenv(f"POOL_{n.upper()}_QUEUE", str(d)) or 0) for n, d in {"ui": 0, "ai": 64, "osint": 128, "pay": 16}.items()}
+UPDATES_MAX_INFLIGHT = int(os.getenv("UPDATES_MAX_INFLIGHT","1024") or "1024")  # سقف PTB العام؛ أعلى من مجموع limit + queue للفئات الثقيلة
+MODE_POOLS = {"ai_chat": "ai", "writer": "ai", "translate": "ai", "link_scan": "osint", "email_check": "osint", "geo_ip": "osint"}
+
+class WorkPool:
+    """Semaphore لفئة عمل مع مقاييس: active و waiting (عمق الطابور) وزمن الانتظار."""
+    def __init__(self, name, limit, queue_max=0):
+        self.name, self.limit, self.queue_max = name, limit, queue_max
+        self._sem = asyncio.Semaphore(limit)
+        self.active = self.waiting = self.peak_waiting = self.done = self.rejected = 0
+        self.wait_total = self.wait_max = 0.0
+
+    def admit(self) -> bool:
+        """False إن كانت المقاعد والطابور ممتلئين: المستدعي يرد "مشغول" بدل الانتظار. يُستدعى مباشرة قبل async with."""
+        if self.queue_max and self.active >= self.limit and self.waiting >= self.queue_max:
+            self.rejected += 1; return False
+        return True
+
+    async def __aenter__(self):
+        t0 = time.perf_counter()
+        self.waiting += 1; self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        w = time.perf_counter() - t0
+        self.wait_total += w; self.wait_max = max(self.wait_max, w)
+        self.active += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self.active -= 1; self.done += 1
+        self._sem.release()
+
+    def stats(self) -> str:
+        avg = self.wait_total / self.done * 1000 if self.done else 0.0
+        return (f"{self.name:<6} limit={self.limit} queue={self.queue_max or '-'} active={self.active} waiting={self.waiting} "
+                f"peak={self.peak_waiting} done={self.done} rejected={self.rejected} wait_avg={avg:.1f}ms wait_max={self.wait_max*1000:.1f}ms")
+
+WORK_POOLS = {n: WorkPool(n, lim, POOL_QUEUES.get(n, 0)) for n, lim in POOL_LIMITS.items()}
+
+def pool_stats() -> str:
+    return "\n".join(p.stats() for p in WORK_POOLS.values())
 
 # ------------- Telegram UI -------------
+# الكيبوردات الثابتة كائنات غير قابلة للتعديل (PTB) → تُبنى مرة لكل (كيبورد, لغة) وتُعاد مشاركتها
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
 def gate_kb(lang="ar"):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📣 " + ("الانضمام للقناة" if lang=="ar" else "Join Channel"), url=MAIN_CHANNEL_LINK or "https://t.me/")],
@@ -696,6 +1972,10 @@ def gate_kb(lang="ar"):
     ])
 
 def main_menu_kb(uid, lang="ar"):
+    return _main_menu_kb(lang)
+
+@lru_cache(maxsize=None)
+def _main_menu_kb(lang):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(T("btn_myinfo", lang=lang), callback_data="myinfo")],
         [InlineKeyboardButton(T("btn_lang", lang=lang), callback_data="pick_lang")],
@@ -704,6 +1984,7 @@ def main_menu_kb(uid, lang="ar"):
         [InlineKeyboardButton(T("btn_sections", lang=lang), callback_data="sections")]
     ])
 
+@lru_cache(maxsize=None)
 def sections_kb(lang="ar"):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton(T("sec_ai", lang=lang), callback_data="sec_ai")],
@@ -715,12 +1996,86 @@ def sections_kb(lang="ar"):
         [InlineKeyboardButton(T("back", lang=lang), callback_data="back_home")]
     ])
 
+@lru_cache(maxsize=None)
 def ai_stop_kb(lang="ar"):
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("🔚 " + ("إنهاء" if lang=="ar" else "Stop"), callback_data="ai_stop")],
         [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
     ])
 
+@lru_cache(maxsize=None)
+def back_kb(lang="ar", to="sections"):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(T("back", lang=lang), callback_data=to)]])
+
+@lru_cache(maxsize=None)
+def pick_lang_kb(lang="ar"):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(T("lang_ar", lang=lang), callback_data="set_lang_ar"),
+         InlineKeyboardButton(T("lang_en", lang=lang), callback_data="set_lang_en")],
+        [InlineKeyboardButton(T("back", lang=lang), callback_data="back_home")]
+    ])
+
+@lru_cache(maxsize=None)
+def ai_tools_kb(lang="ar"):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(T("btn_ai_chat", lang=lang), callback_data="ai_chat")],
+        [InlineKeyboardButton(T("btn_ai_write", lang=lang), callback_data="ai_write")],
+        [InlineKeyboardButton(T("btn_ai_translate", lang=lang), callback_data="ai_translate")],
+        [InlineKeyboardButton(T("btn_ai_image", lang=lang), callback_data="ai_image")],
+        [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
+    ])
+
+@lru_cache(maxsize=None)
+def security_kb(lang="ar"):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(T("btn_urlscan", lang=lang), callback_data="sec_security_url")],
+        [InlineKeyboardButton(T("btn_emailcheck", lang=lang), callback_data="sec_security_email")],
+        [InlineKeyboardButton(T("btn_geolookup", lang=lang), callback_data="sec_security_geo")],
+        [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
+    ])
+
+@lru_cache(maxsize=None)
+def services_kb(lang="ar"):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(T("btn_games", lang=lang), callback_data="serv_games")],
+        [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
+    ])
+
+@lru_cache(maxsize=None)
+def games_kb(lang="ar"):
+    rows = [[InlineKeyboardButton(name, url=url)] for name,url in GAMES_LINKS]
+    rows.append([InlineKeyboardButton(T("back", lang=lang), callback_data="sec_services")])
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
+def unban_kb(lang="ar"):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Instagram", callback_data="unban_instagram")],
+        [InlineKeyboardButton("Facebook", callback_data="unban_facebook")],
+        [InlineKeyboardButton("Telegram", callback_data="unban_telegram")],
+        [InlineKeyboardButton("Epic Games", callback_data="unban_epic")],
+        [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
+    ])
+
+@lru_cache(maxsize=None)
+def courses_kb(lang="ar"):
+    courses = [
+        (T("course_python", lang=lang), COURSE_PYTHON_URL),
+        (T("course_cyber",  lang=lang), COURSE_CYBER_URL),
+        (T("course_eh",     lang=lang), COURSE_EH_URL),
+        (T("course_ecom",   lang=lang), COURSE_ECOM_URL),
+    ]
+    rows = [[InlineKeyboardButton(title, url=url)] for title,url in courses if url]
+    rows.append([InlineKeyboardButton(T("back", lang=lang), callback_data="sections")])
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
+def darkgpt_kb(lang="ar"):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Open", url=DARK_GPT_URL)],
+        [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
+    ])
+
 async def safe_edit(q, text=None, kb=None):
     try:
         if text is not None:
@@ -739,7 +2094,53 @@ try: ALLOWED_STATUSES.add(ChatMemberStatus.CREATOR)
 except: pass
 
 CHANNEL_ID = None
-_member_cache = {}
+
+# نتائج get_chat_member: كاش محدود بالحجم، بصلاحية مختلفة للإيجابي والسلبي، وطلب واحد لكل مستخدم في نفس اللحظة
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE","20000") or "20000")
+MEMBER_TTL_POS = float(os.getenv("MEMBER_TTL_POS","600") or "600")
+MEMBER_TTL_NEG = float(os.getenv("MEMBER_TTL_NEG","30") or "30")
+_member_cache = TTLCache(MEMBER_CACHE_SIZE)
+_member_flight = SingleFlight()
+
+# حالة العضوية من تحديثات chat_member (مصدر موثوق) — ذاكرة ثم جدول channel_members، والـAPI احتياط فقط
+MEMBER_STATE_CACHE = int(os.getenv("MEMBER_STATE_CACHE","100000") or "100000")
+_MEMBER_UNKNOWN = "?"
+_member_state = TTLCache(MEMBER_STATE_CACHE)
+member_stats = {"events": 0, "known_hits": 0, "api_checks": 0}
+
+async def member_state_get(user_id: int) -> bool | None:
+    v = _member_state.get(user_id)
+    if v is None:
+        r = await _adb.fetchone("SELECT is_member FROM channel_members WHERE user_id=?", (str(user_id),))
+        cur = _member_state.get(user_id)   # جواب أحدث وصل أثناء القراءة يغلب صف الـ DB القديم
+        if cur is None: _member_state.set(user_id, v := bool(r["is_member"]) if r else _MEMBER_UNKNOWN)
+        else: v = cur
+    return None if v is _MEMBER_UNKNOWN else v
+
+async def member_state_set(user_id: int, ok: bool, status: str = ""):
+    _member_state.set(user_id, ok)
+    await _adb.execute(
+        "INSERT INTO channel_members (user_id,chat_id,is_member,status,updated_at) VALUES (?,?,?,?,?) "
+        "ON CONFLICT(user_id) DO UPDATE SET chat_id=excluded.chat_id, is_member=excluded.is_member, "
+        "status=excluded.status, updated_at=excluded.updated_at",
+        (str(user_id), CHANNEL_ID, 1 if ok else 0, status, int(time.time())), wait=False)
+
+async def on_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تحديثات chat_member للقناة (يتطلب أن يكون البوت مشرفاً فيها)."""
+    cmu = update.chat_member
+    if cmu is None: return
+    chat = cmu.chat
+    if CHANNEL_ID is not None:
+        if chat.id != CHANNEL_ID: return
+    elif (chat.username or "").lower() not in {u.lower() for u in MAIN_CHANNEL_USERNAMES}:
+        return
+    new = cmu.new_chat_member
+    ok = new.status in ALLOWED_STATUSES
+    member_stats["events"] += 1
+    _member_cache.pop(new.user.id, None)
+    await member_state_set(new.user.id, ok, str(new.status))
+    await user_set_verify_async(new.user.id, ok)
+
 async def resolve_channel_id(bot):
     global CHANNEL_ID
     CHANNEL_ID = None
@@ -751,54 +2152,95 @@ async def resolve_channel_id(bot):
         except Exception as e:
             log.warning("[startup] get_chat @%s failed: %s", u, e)
 
-async def is_member(context, user_id: int, force=False, retries=3, backoff=0.7) -> bool:
-    now = time.time()
-    if not force:
-        c = _member_cache.get(user_id)
-        if c and c[1] > now: return c[0]
+async def _member_api_check(bot, user_id: int, retries: int, backoff: float) -> tuple[bool, str | None]:
+    """يرجع (عضو؟, آخر حالة مؤكدة من الـAPI أو None إن فشلت كل المحاولات)."""
+    member_stats["api_checks"] += 1
     targets = [CHANNEL_ID] if CHANNEL_ID is not None else [f"@{u}" for u in MAIN_CHANNEL_USERNAMES]
+    answered = None
     for attempt in range(1, retries+1):
         for t in targets:
             try:
-                cm = await context.bot.get_chat_member(t, user_id)
-                ok = getattr(cm,"status",None) in ALLOWED_STATUSES
-                if ok:
-                    _member_cache[user_id] = (True, now+60); user_set_verify(user_id, True); return True
+                cm = await bot.get_chat_member(t, user_id)
+                answered = str(getattr(cm,"status",""))
+                if getattr(cm,"status",None) in ALLOWED_STATUSES:
+                    _member_cache.set(user_id, True, ttl=MEMBER_TTL_POS); await user_set_verify_async(user_id, True)
+                    return True, answered
             except Exception as e:
                 log.warning("[is_member] try#%d %s  %s", attempt, t, e)
         if attempt < retries: await asyncio.sleep(backoff*attempt)
-    _member_cache[user_id] = (False, now+60)
-    user_set_verify(user_id, False); return False
+    _member_cache.set(user_id, False, ttl=MEMBER_TTL_NEG)
+    await user_set_verify_async(user_id, False)
+    return False, answered
+
+async def is_member(context, user_id: int, force=False, retries=3, backoff=0.7) -> bool:
+    if not force:
+        known = await member_state_get(user_id)
+        if known is not None:
+            member_stats["known_hits"] += 1; return known
+        c = _member_cache.get(user_id)
+        if c is not None: return c
+    ok, answered = await _member_flight.do(user_id, lambda: _member_api_check(context.bot, user_id, retries, backoff))
+    # الإيجابي يُحفظ من أي مسار (الأعضاء الحاليون لا يعودون للـAPI)؛ السلبي من زر التحقق فقط،
+    # لأن غير العضو اليوم قد ينضم دون أن يصلنا chat_member — وزر التحقق يعيد الفحص دائماً
+    if answered is not None and (ok or force):
+        await member_state_set(user_id, ok, answered)
+    return ok
 
-async def must_join_or_vip(context, uid) -> bool:
-    return user_is_vip(uid) or await is_member(context, uid, retries=3, backoff=0.7)
+async def must_join_or_vip(context, uid, u=None) -> bool:
+    return await user_is_vip_async(uid, u) or await is_member(context, uid, retries=3, backoff=0.7)
 
 # ------------- Handlers -------------
 async def on_startup(app: Application):
+    global _geo_task
+    await _adb.start()
+    await _ai_cache.purge_expired()
+    if _geo_index is None and (_geo_task is None or _geo_task.done()):
+        _geo_task = spawn(load_geo_index(), "geo-load")
+    _paylink_tokens.start()
+    _pay_inbox.start(app.bot)
+    _ai_state.writer.start()
+    _user_journal.start()
+    await start_http_server(app)
     try:
-        await app.bot.delete_webhook(drop_pending_updates=True)
+        if TG_WEBHOOK:
+            await app.bot.set_webhook(_public_url(TG_WEBHOOK_PATH), secret_token=TG_WEBHOOK_SECRET,
+                                      allowed_updates=Update.ALL_TYPES, max_connections=100)
+        else:
+            await app.bot.delete_webhook(drop_pending_updates=True)
     except Exception as e:
-        log.warning("[startup] delete_webhook: %s", e)
+        log.warning("[startup] %s: %s", "set_webhook" if TG_WEBHOOK else "delete_webhook", e)
     await resolve_channel_id(app.bot)
+    await register_commands(app.bot)
+
+async def register_commands(bot):
     try:
-        await app.bot.set_my_commands([BotCommand("start","Start"), BotCommand("help","Help")], scope=BotCommandScopeDefault())
-        await app.bot.set_my_commands(
+        await bot.set_my_commands([BotCommand("start","Start"), BotCommand("help","Help")], scope=BotCommandScopeDefault())
+        await bot.set_my_commands(
             [
                 BotCommand("start","Start"), BotCommand("help","Help"),
                 BotCommand("id","Your ID"), BotCommand("grant","Grant VIP"),
                 BotCommand("revoke","Revoke VIP"), BotCommand("vipinfo","VIP Info"),
                 BotCommand("refreshcmds","Refresh Cmds"), BotCommand("aidiag","AI diag"),
-                BotCommand("libdiag","Lib versions"), BotCommand("paylist","Payments"), BotCommand("restart","Restart")
+                BotCommand("libdiag","Lib versions"), BotCommand("paylist","Payments"), BotCommand("routestats","Route stats"), BotCommand("ratestats","Rate limits"), BotCommand("pools","Work pools"), BotCommand("profile","Profile N sec"), BotCommand("restart","Restart")
             ],
             scope=BotCommandScopeChat(chat_id=OWNER_ID)
         )
     except Exception as e:
         log.warning("[startup] set_my_commands: %s", e)
 
+async def on_shutdown(app: Application):
+    if _geo_task is not None: _geo_task.cancel()
+    await stop_http_server()
+    await _pay_inbox.close()
+    await _paylink_tokens.close()
+    await _http.close()
+    await _ai_state.writer.close()
+    await _user_journal.close()
+    await _adb.close()
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    init_db()
     uid = update.effective_user.id
-    u = user_get(uid)
+    u = await user_get_async(uid)
     lang = u.get("pref_lang","ar")
     name = (update.effective_user.full_name or "").strip() or "صديقي"
     greet = T("hello_name", lang=lang, name=name)
@@ -833,219 +2275,255 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    lang = user_get(uid).get("pref_lang","ar")
+    lang = (await user_get_async(uid)).get("pref_lang","ar")
     await update.message.reply_text(T("main_menu", lang=lang), reply_markup=main_menu_kb(uid, lang))
 
-async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    init_db()
-    q = update.callback_query; uid = q.from_user.id
-    u = user_get(uid); lang = u.get("pref_lang","ar")
-    await q.answer()
-
-    if q.data in ("set_lang_ar","set_lang_en"):
-        new = "ar" if q.data.endswith("_ar") else "en"
-        prefs_set_lang(uid, new)
-        await safe_edit(q, T("main_menu", lang=new), kb=main_menu_kb(uid, new)); return
-
-    if q.data == "pick_lang":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(T("lang_ar", lang=lang), callback_data="set_lang_ar"),
-             InlineKeyboardButton(T("lang_en", lang=lang), callback_data="set_lang_en")],
-            [InlineKeyboardButton(T("back", lang=lang), callback_data="back_home")]
-        ])
-        await safe_edit(q, T("start_pick_lang", lang=lang), kb=kb); return
+# callback router: مطابقة تامة عبر dict + مسارات بادئة، مع بوابة لكل مسار وإحصاءات زمن/عدد
+GATE_NONE, GATE_MEMBER, GATE_VIP, GATE_OWNER = "none", "member", "vip", "owner"
+
+class CallbackRouter:
+    def __init__(self):
+        self.exact = {}
+        self.prefixes = []
+        self.stats = {}   # route -> [calls, total_s, max_s]
+
+    def route(self, *keys, prefix=None, gate=GATE_MEMBER, pool="ui"):
+        def deco(fn):
+            for k in keys: self.exact[k] = (k, fn, gate, pool)
+            if prefix: self.prefixes.append((prefix, (prefix + "*", fn, gate, pool)))
+            return fn
+        return deco
+
+    def resolve(self, data: str):
+        r = self.exact.get(data)
+        if r is not None: return r
+        for p, r in self.prefixes:
+            if data.startswith(p): return r
+        return None
 
-    if q.data == "verify":
-        ok = await is_member(context, uid, force=True)
-        await safe_edit(q, T("verify_done", lang=lang) if ok else T("not_verified", lang=lang), kb=main_menu_kb(uid, lang)); return
+    async def _gate(self, gate, q, context, uid, u, lang) -> bool:
+        if gate == GATE_NONE: return True
+        if gate == GATE_OWNER: return uid == OWNER_ID
+        if not await must_join_or_vip(context, uid, u):
+            await safe_edit(q, T("gate_join", lang=lang), kb=gate_kb(lang)); return False
+        if gate == GATE_VIP and not (user_is_vip_record(u) or uid == OWNER_ID):
+            await safe_edit(q, T("vip_only", lang=lang), kb=sections_kb(lang)); return False
+        return True
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        t0 = time.perf_counter()
+        q = update.callback_query; uid = q.from_user.id
+        name, fn, gate, pool = self.resolve(q.data or "") or ("<unknown>", None, GATE_MEMBER, "ui")
+        try:
+            u = await user_get_async(uid); lang = u.get("pref_lang","ar")
+            await q.answer()
+            # البوابة (getChatMember مع retry) خارج الـ pool: المقعد يُحجز لعمل الـ route فقط
+            if await self._gate(gate, q, context, uid, u, lang) and fn is not None:
+                async with WORK_POOLS[pool]:
+                    await fn(q, context, uid, u, lang)
+        finally:
+            dt = time.perf_counter() - t0
+            st = self.stats.get(name)
+            if st is None: st = self.stats[name] = [0, 0.0, 0.0]
+            st[0] += 1; st[1] += dt
+            if dt > st[2]: st[2] = dt
 
-    if not await must_join_or_vip(context, uid):
-        await safe_edit(q, T("gate_join", lang=lang), kb=gate_kb(lang)); return
+    def report(self, top=30) -> str:
+        rows = sorted(self.stats.items(), key=lambda kv: -kv[1][1])[:top]
+        return "\n".join(f"{k:<20} n={n:<6} avg={tot/n*1000:7.2f}ms max={mx*1000:7.2f}ms" for k, (n, tot, mx) in rows) or "no data"
 
-    if q.data == "myinfo":
-        await safe_edit(q, T("myinfo", lang=lang, name=q.from_user.full_name, uid=uid, lng=lang.upper()), kb=main_menu_kb(uid, lang)); return
-    if q.data == "back_home":
-        await safe_edit(q, T("main_menu", lang=lang), kb=main_menu_kb(uid, lang)); return
+router = CallbackRouter()
 
-    # VIP
-    if q.data == "vip":
-        if user_is_vip(uid) or uid == OWNER_ID:
-            await safe_edit(q, T("vip_status_on", lang=lang), kb=main_menu_kb(uid, lang)); return
-        ref = payments_create(uid, VIP_PRICE_SAR, "paylink")
-        try:
-            if PAYLINK_API_ID and PAYLINK_API_SECRET:
+async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await router.dispatch(update, context)
+
+@router.route("set_lang_ar", "set_lang_en", gate=GATE_NONE)
+async def _r_set_lang(q, context, uid, u, lang):
+    new = "ar" if q.data.endswith("_ar") else "en"
+    await prefs_set_lang_async(uid, new)
+    await safe_edit(q, T("main_menu", lang=new), kb=main_menu_kb(uid, new))
+
+@router.route("pick_lang", gate=GATE_NONE)
+async def _r_pick_lang(q, context, uid, u, lang):
+    await safe_edit(q, T("start_pick_lang", lang=lang), kb=pick_lang_kb(lang))
+
+@router.route("verify", gate=GATE_NONE)
+async def _r_verify(q, context, uid, u, lang):
+    ok = await is_member(context, uid, force=True)
+    await safe_edit(q, T("verify_done", lang=lang) if ok else T("not_verified", lang=lang), kb=main_menu_kb(uid, lang))
+
+@router.route("myinfo")
+async def _r_myinfo(q, context, uid, u, lang):
+    await safe_edit(q, T("myinfo", lang=lang, name=q.from_user.full_name, uid=uid, lng=lang.upper()), kb=main_menu_kb(uid, lang))
+
+@router.route("back_home")
+async def _r_home(q, context, uid, u, lang):
+    await safe_edit(q, T("main_menu", lang=lang), kb=main_menu_kb(uid, lang))
+
+# VIP
+@router.route("vip")
+async def _r_vip(q, context, uid, u, lang):
+    if user_is_vip_record(u) or uid == OWNER_ID:
+        await safe_edit(q, T("vip_status_on", lang=lang), kb=main_menu_kb(uid, lang)); return
+    use_paylink = bool(PAYLINK_API_ID and PAYLINK_API_SECRET)
+    if use_paylink and not WORK_POOLS["pay"].admit():
+        await safe_edit(q, T("busy", lang=lang), kb=main_menu_kb(uid, lang)); return
+    ref = await payments_create_async(uid, VIP_PRICE_SAR, "paylink")
+    try:
+        if use_paylink:
+            async with WORK_POOLS["pay"]:   # مقعد الدفع لاستدعاء Paylink فقط، لا لكتابة القاعدة أو تعديل الرسالة
                 url, _ = await paylink_create_invoice(ref, VIP_PRICE_SAR, q.from_user.full_name or "Telegram User")
-            else:
-                url = _build_checkout_link(ref) or "https://paylink.sa"
-            txt = f"{T('vip_status_off',lang=lang)} — {VIP_PRICE_SAR:.2f} SAR\n🔖 ref: <code>{_escape(ref)}</code>"
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("💳 Pay", url=url)],
-                [InlineKeyboardButton("✅ Check", callback_data=f"verify_pay_{ref}")],
-                [InlineKeyboardButton(T("back", lang=lang), callback_data="back_home")]
-            ])
-            await safe_edit(q, txt, kb=kb)
-        except Exception as e:
-            log.error("[vip] %s", e)
-            await safe_edit(q, "⚠️ تعذّر إنشاء رابط الدفع حالياً.", kb=main_menu_kb(uid, lang))
-        return
-
-    if q.data.startswith("verify_pay_"):
-        ref = q.data.split("_",2)[2]
-        st = payments_status(ref)
-        if st == "paid" or user_is_vip(uid):
-            await safe_edit(q, T("vip_status_on", lang=lang), kb=main_menu_kb(uid, lang))
         else:
-            await safe_edit(q, T("not_verified", lang=lang)+f"\nref=<code>{_escape(ref)}</code>", kb=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Check", callback_data=f"verify_pay_{ref}")],
-                [InlineKeyboardButton(T("back", lang=lang), callback_data="back_home")]
-            ]))
-        return
-
-    # sections
-    if q.data == "sections":
-        await safe_edit(q, T("sections", lang=lang), kb=sections_kb(lang)); return
-
-    # AI (VIP only)
-    if q.data == "sec_ai":
-        if not user_is_vip(uid) and uid != OWNER_ID:
-            await safe_edit(q, T("vip_only", lang=lang), kb=sections_kb(lang)); return
+            url = _build_checkout_link(ref) or "https://paylink.sa"
+        txt = f"{T('vip_status_off',lang=lang)} — {VIP_PRICE_SAR:.2f} SAR\n🔖 ref: <code>{_escape(ref)}</code>"
         kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(T("btn_ai_chat", lang=lang), callback_data="ai_chat")],
-            [InlineKeyboardButton(T("btn_ai_write", lang=lang), callback_data="ai_write")],
-            [InlineKeyboardButton(T("btn_ai_translate", lang=lang), callback_data="ai_translate")],
-            [InlineKeyboardButton(T("btn_ai_image", lang=lang), callback_data="ai_image")],
-            [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
-        ])
-        await safe_edit(q, T("page_ai", lang=lang), kb=kb); return
-
-    if q.data == "ai_chat":
-        ai_set_mode(uid, "ai_chat"); await safe_edit(q, "✳️ أرسل رسالتك…", kb=ai_stop_kb(lang)); return
-    if q.data == "ai_write":
-        ai_set_mode(uid, "writer"); await safe_edit(q, "✳️ اكتب وصف الحملة/المنتج وسأصيغ إعلانًا جذابًا.", kb=ai_stop_kb(lang)); return
-    if q.data == "ai_translate":
-        ai_set_mode(uid, "translate"); await safe_edit(q, "✳️ أرسل النص — سيتم اكتشاف اللغة تلقائيًا (AR ↔ EN).", kb=ai_stop_kb(lang)); return
-    if q.data == "ai_image":
-        ai_set_mode(uid, "image_ai"); await safe_edit(q, "✳️ اكتب وصف الصورة المطلوب توليدها.", kb=ai_stop_kb(lang)); return
-    if q.data == "ai_stop":
-        ai_set_mode(uid, None); await safe_edit(q, T("main_menu", lang=lang), kb=main_menu_kb(uid, lang)); return
-
-    # Security (VIP only)
-    if q.data == "sec_security":
-        if not user_is_vip(uid) and uid != OWNER_ID:
-            await safe_edit(q, T("vip_only", lang=lang), kb=sections_kb(lang)); return
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(T("btn_urlscan", lang=lang), callback_data="sec_security_url")],
-            [InlineKeyboardButton(T("btn_emailcheck", lang=lang), callback_data="sec_security_email")],
-            [InlineKeyboardButton(T("btn_geolookup", lang=lang), callback_data="sec_security_geo")],
-            [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
+            [InlineKeyboardButton("💳 Pay", url=url)],
+            [InlineKeyboardButton("✅ Check", callback_data=f"verify_pay_{ref}")],
+            [InlineKeyboardButton(T("back", lang=lang), callback_data="back_home")]
         ])
-        await safe_edit(q, T("page_security", lang=lang), kb=kb); return
+        await safe_edit(q, txt, kb=kb)
+    except Exception as e:
+        log.error("[vip] %s", e)
+        await safe_edit(q, "⚠️ تعذّر إنشاء رابط الدفع حالياً.", kb=main_menu_kb(uid, lang))
+
+@router.route(prefix="verify_pay_")
+async def _r_verify_pay(q, context, uid, u, lang):
+    ref = q.data.split("_",2)[2]
+    st = await payments_status_async(ref)
+    if st == "paid" or user_is_vip_record(u):
+        await safe_edit(q, T("vip_status_on", lang=lang), kb=main_menu_kb(uid, lang))
+    else:
+        await safe_edit(q, T("not_verified", lang=lang)+f"\nref=<code>{_escape(ref)}</code>", kb=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Check", callback_data=f"verify_pay_{ref}")],
+            [InlineKeyboardButton(T("back", lang=lang), callback_data="back_home")]
+        ]))
+
+# sections
+@router.route("sections")
+async def _r_sections(q, context, uid, u, lang):
+    await safe_edit(q, T("sections", lang=lang), kb=sections_kb(lang))
+
+@router.route("sec_ai", gate=GATE_VIP)
+async def _r_sec_ai(q, context, uid, u, lang):
+    await safe_edit(q, T("page_ai", lang=lang), kb=ai_tools_kb(lang))
+
+@router.route("sec_security", gate=GATE_VIP)
+async def _r_sec_security(q, context, uid, u, lang):
+    await safe_edit(q, T("page_security", lang=lang), kb=security_kb(lang))
+
+# اختيار أداة: callback -> (mode, رسالة التعليمات)
+TOOL_MODES = {
+    "ai_chat": ("ai_chat", "✳️ أرسل رسالتك…"),
+    "ai_write": ("writer", "✳️ اكتب وصف الحملة/المنتج وسأصيغ إعلانًا جذابًا."),
+    "ai_translate": ("translate", "✳️ أرسل النص — سيتم اكتشاف اللغة تلقائيًا (AR ↔ EN)."),
+    "ai_image": ("image_ai", "✳️ اكتب وصف الصورة المطلوب توليدها."),
+    "sec_security_url": ("link_scan", "🛡️ أرسل الرابط للفحص."),
+    "sec_security_email": ("email_check", "✉️ أرسل الإيميل للفحص."),
+    "sec_security_geo": ("geo_ip", "📍 أرسل IP أو دومين."),
+}
+
+@router.route(*TOOL_MODES)
+async def _r_tool_mode(q, context, uid, u, lang):
+    mode, prompt = TOOL_MODES[q.data]
+    await ai_set_mode_async(uid, mode); await safe_edit(q, prompt, kb=ai_stop_kb(lang))
+
+@router.route("ai_stop")
+async def _r_ai_stop(q, context, uid, u, lang):
+    await ai_set_mode_async(uid, None); await safe_edit(q, T("main_menu", lang=lang), kb=main_menu_kb(uid, lang))
+
+# Services
+@router.route("sec_services")
+async def _r_services(q, context, uid, u, lang):
+    await safe_edit(q, T("page_services", lang=lang), kb=services_kb(lang))
+
+@router.route("serv_games")
+async def _r_games(q, context, uid, u, lang):
+    await safe_edit(q, "🎮 أفضل مواقع شراء الألعاب والاشتراكات:", kb=games_kb(lang))
+
+# Unban (رسائل قوية)
+UNBAN_APPEALS = {
+    "instagram": ("Instagram Support Appeal",
+                  "Hello Instagram Support,\n\nMy account has been restricted/disabled in error. I strictly adhere to the Community Guidelines and believe this action was triggered by an automated system. I respectfully request a manual review and reinstatement.\n\nI am ready to provide any required verification or additional information. Thank you for your time.",
+                  "https://help.instagram.com/contact/606967319425038"),
+    "facebook": ("Facebook Support Appeal",
+                 "Hello Facebook Support,\n\nMy account was mistakenly restricted/disabled. I fully comply with the Community Standards and believe this was an automated false positive. Please conduct a manual review and restore access.\n\nI can provide identity or evidence if needed. Thank you.",
+                 "https://www.facebook.com/help/contact/260749603972907"),
+    "telegram": ("Telegram Support Appeal",
+                 "Hello Telegram Support,\n\nMy account/channel appears to be limited due to a false positive. I comply with the Terms of Service and local laws. Please manually review my case and lift the restriction.\n\nThanks for your help.",
+                 "https://telegram.org/support"),
+    "epic": ("Epic Games Support Appeal",
+             "Hello Epic Games Support,\n\nMy account was banned by mistake. I respect all your policies and never intended to violate any rule. Please review my case manually and remove the ban. I can verify ownership or provide any evidence required.\n\nThank you.",
+             "https://www.epicgames.com/help/en-US/c4059"),
+}
+
+@router.route("sec_unban")
+async def _r_unban_menu(q, context, uid, u, lang):
+    await safe_edit(q, "اختر المنصة لعرض رسالة قوية لإرسالها للدعم:", kb=unban_kb(lang))
+
+@router.route(prefix="unban_")
+async def _r_unban(q, context, uid, u, lang):
+    title, msg, link = UNBAN_APPEALS.get(q.data.split("_",1)[1], ("Support Appeal", "", ""))
+    await safe_edit(q, f"📋 <b>{_escape(title)}</b>\n<code>{_escape(msg)}</code>\n\n🔗 {link}", kb=back_kb(lang, "sec_unban"))
 
-    if q.data == "sec_security_url":
-        ai_set_mode(uid, "link_scan"); await safe_edit(q, "🛡️ أرسل الرابط للفحص.", kb=ai_stop_kb(lang)); return
-    if q.data == "sec_security_email":
-        ai_set_mode(uid, "email_check"); await safe_edit(q, "✉️ أرسل الإيميل للفحص.", kb=ai_stop_kb(lang)); return
-    if q.data == "sec_security_geo":
-        ai_set_mode(uid, "geo_ip"); await safe_edit(q, "📍 أرسل IP أو دومين.", kb=ai_stop_kb(lang)); return
+# Courses
+@router.route("sec_courses")
+async def _r_courses(q, context, uid, u, lang):
+    await safe_edit(q, T("page_courses", lang=lang), kb=courses_kb(lang))
 
-    # Services
-    if q.data == "sec_services":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton(T("btn_games", lang=lang), callback_data="serv_games")],
-            [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
-        ])
-        await safe_edit(q, T("page_services", lang=lang), kb=kb); return
-
-    if q.data == "serv_games":
-        rows = [[InlineKeyboardButton(name, url=url)] for name,url in GAMES_LINKS]
-        rows.append([InlineKeyboardButton(T("back", lang=lang), callback_data="sec_services")])
-        await safe_edit(q, "🎮 أفضل مواقع شراء الألعاب والاشتراكات:", kb=InlineKeyboardMarkup(rows)); return
-
-    # Unban (رسائل قوية)
-    if q.data == "sec_unban":
-        rows = [
-            [InlineKeyboardButton("Instagram", callback_data="unban_instagram")],
-            [InlineKeyboardButton("Facebook", callback_data="unban_facebook")],
-            [InlineKeyboardButton("Telegram", callback_data="unban_telegram")],
-            [InlineKeyboardButton("Epic Games", callback_data="unban_epic")],
-            [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
-        ]
-        await safe_edit(q, "اختر المنصة لعرض رسالة قوية لإرسالها للدعم:", kb=InlineKeyboardMarkup(rows)); return
-
-    if q.data.startswith("unban_"):
-        key = q.data.split("_",1)[1]
-        strong = {
-            "instagram": ("Instagram Support Appeal",
-                          "Hello Instagram Support,\n\nMy account has been restricted/disabled in error. I strictly adhere to the Community Guidelines and believe this action was triggered by an automated system. I respectfully request a manual review and reinstatement.\n\nI am ready to provide any required verification or additional information. Thank you for your time."),
-            "facebook": ("Facebook Support Appeal",
-                         "Hello Facebook Support,\n\nMy account was mistakenly restricted/disabled. I fully comply with the Community Standards and believe this was an automated false positive. Please conduct a manual review and restore access.\n\nI can provide identity or evidence if needed. Thank you."),
-            "telegram": ("Telegram Support Appeal",
-                         "Hello Telegram Support,\n\nMy account/channel appears to be limited due to a false positive. I comply with the Terms of Service and local laws. Please manually review my case and lift the restriction.\n\nThanks for your help."),
-            "epic": ("Epic Games Support Appeal",
-                     "Hello Epic Games Support,\n\nMy account was banned by mistake. I respect all your policies and never intended to violate any rule. Please review my case manually and remove the ban. I can verify ownership or provide any evidence required.\n\nThank you.")
-        }
-        title, msg = strong.get(key, ("Support Appeal",""))
-        link = {
-            "instagram":"https://help.instagram.com/contact/606967319425038",
-            "facebook":"https://www.facebook.com/help/contact/260749603972907",
-            "telegram":"https://telegram.org/support",
-            "epic":"https://www.epicgames.com/help/en-US/c4059"
-        }.get(key,"")
-        await safe_edit(q, f"📋 <b>{_escape(title)}</b>\n<code>{_escape(msg)}</code>\n\n🔗 {link}", kb=InlineKeyboardMarkup([[InlineKeyboardButton(T("back", lang=lang), callback_data="sec_unban")]])); return
-
-    # Courses
-    if q.data == "sec_courses":
-        courses = [
-            (T("course_python", lang=lang), COURSE_PYTHON_URL),
-            (T("course_cyber",  lang=lang), COURSE_CYBER_URL),
-            (T("course_eh",     lang=lang), COURSE_EH_URL),
-            (T("course_ecom",   lang=lang), COURSE_ECOM_URL),
-        ]
-        rows = [[InlineKeyboardButton(title, url=url)] for title,url in courses if url]
-        rows.append([InlineKeyboardButton(T("back", lang=lang), callback_data="sections")])
-        await safe_edit(q, T("page_courses", lang=lang), kb=InlineKeyboardMarkup(rows)); return
-
-    # Dark GPT (VIP only)
-    if q.data == "sec_darkgpt":
-        if not user_is_vip(uid) and uid != OWNER_ID:
-            await safe_edit(q, T("vip_only", lang=lang), kb=sections_kb(lang)); return
-        await safe_edit(q, f"{T('sec_darkgpt',lang=lang)}\n{_escape(DARK_GPT_URL)}", kb=InlineKeyboardMarkup([
-            [InlineKeyboardButton("Open", url=DARK_GPT_URL)],
-            [InlineKeyboardButton(T("back", lang=lang), callback_data="sections")]
-        ])); return
+# Dark GPT (VIP only)
+@router.route("sec_darkgpt", gate=GATE_VIP)
+async def _r_darkgpt(q, context, uid, u, lang):
+    await safe_edit(q, f"{T('sec_darkgpt',lang=lang)}\n{_escape(DARK_GPT_URL)}", kb=darkgpt_kb(lang))
 
 # messages guard
 async def guard_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
-    u = user_get(uid); lang = u.get("pref_lang","ar")
-    if not await must_join_or_vip(context, uid):
+    u = await user_get_async(uid); lang = u.get("pref_lang","ar")
+    if not await must_join_or_vip(context, uid, u):
         await update.message.reply_text(T("gate_join", lang=lang), reply_markup=gate_kb(lang)); return
 
-    mode, extra = ai_get_mode(uid)
+    mode, extra = await ai_get_mode_async(uid)
     msg = update.message
 
-    if msg.text and not msg.text.startswith("/"):
+    if msg.text and not msg.text.startswith("/") and mode in MODE_POOLS:
         text = msg.text.strip()
-        if mode == "ai_chat":
-            await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
-            await update.message.reply_text(ai_chat_reply(text), reply_markup=ai_stop_kb(lang)); return
-        if mode == "writer":
-            out = await ai_write(text); await update.message.reply_text(out, parse_mode="HTML"); return
-        if mode == "translate":
-            out = await ai_auto_translate(text); await update.message.reply_text(out, parse_mode="HTML"); return
-        if mode == "link_scan":
-            out = await link_scan(text); await update.message.reply_text(out, parse_mode="HTML", disable_web_page_preview=True); return
-        if mode == "email_check":
-            out = await osint_email(text); await update.message.reply_text(out, parse_mode="HTML"); return
-        if mode == "geo_ip":
-            target = text
-            if re.fullmatch(r"[a-zA-Z0-9.-]+\.[A-Za-z]{2,63}", target or ""):
-                ip = resolve_ip(target); target = ip or target
-            data = await fetch_geo(target); await update.message.reply_text(fmt_geo(data), parse_mode="HTML"); return
+        wait = rate_check(uid, mode)
+        if wait > 0:
+            if _rl_notified.get(uid) is None:
+                _rl_notified.set(uid, True, ttl=wait)
+                await update.message.reply_text(T("slow_down", lang=lang, sec=math.ceil(wait)))
+            return
+        pool = WORK_POOLS[MODE_POOLS[mode]]
+        if not pool.admit():
+            await update.message.reply_text(T("busy", lang=lang)); return
+        async with pool:
+            await _run_mode(update, context, mode, text, lang)
+        return
 
     if not mode:
         await update.message.reply_text(T("main_menu", lang=lang), reply_markup=main_menu_kb(uid, lang))
 
+async def _run_mode(update, context, mode, text, lang):
+    if mode == "ai_chat":
+        await context.bot.send_chat_action(update.effective_chat.id, ChatAction.TYPING)
+        uid = update.effective_user.id
+        _, chat = await ai_get_mode_async(uid)
+        reply = await ai_reply_streaming(update.message, "ai_chat", text, kb=ai_stop_kb(lang),
+                                         chat=chat if AI_CHAT_HISTORY_TOKENS > 0 else None)
+        if reply: await chat_record(uid, text, reply)
+        return
+    if mode in ("writer", "translate"):
+        await ai_reply_streaming(update.message, mode, text, parse_mode="HTML"); return
+    if mode == "link_scan":
+        out = await link_scan(text); await update.message.reply_text(out, parse_mode="HTML", disable_web_page_preview=True); return
+    if mode == "email_check":
+        out = await osint_email(text); await update.message.reply_text(out, parse_mode="HTML"); return
+    if mode == "geo_ip":
+        target = text
+        if re.fullmatch(r"[a-zA-Z0-9.-]+\.[A-Za-z]{2,63}", target or ""):
+            ip = await resolve_ip(target); target = ip or target
+        data = await fetch_geo(target); await update.message.reply_text(fmt_geo(data), parse_mode="HTML"); return
+
 # owner cmds
 async def cmd_id(update, context):
     if update.effective_user.id == OWNER_ID:
@@ -1054,26 +2532,27 @@ async def cmd_id(update, context):
 async def grant(update, context):
     if update.effective_user.id != OWNER_ID: return
     if not context.args: await update.message.reply_text("Usage: /grant <user_id>"); return
-    user_grant(context.args[0]); await update.message.reply_text("✅ granted")
+    await user_grant_async(context.args[0]); await update.message.reply_text("✅ granted")
 
 async def revoke(update, context):
     if update.effective_user.id != OWNER_ID: return
     if not context.args: await update.message.reply_text("Usage: /revoke <user_id>"); return
-    with _db_lock: _db().execute("UPDATE users SET premium=0, vip_forever=0 WHERE id=?", (str(context.args[0]),)); _db().commit()
+    await user_revoke_async(context.args[0])
     await update.message.reply_text("❌ revoked")
 
 async def vipinfo(update, context):
     if update.effective_user.id != OWNER_ID: return
     if not context.args: await update.message.reply_text("Usage: /vipinfo <user_id>"); return
-    await update.message.reply_text(json.dumps(user_get(context.args[0]), ensure_ascii=False, indent=2))
+    await update.message.reply_text(json.dumps(await user_get_async(context.args[0]), ensure_ascii=False, indent=2))
 
 async def refresh_cmds(update, context):
     if update.effective_user.id != OWNER_ID: return
-    await on_startup(context.application); await update.message.reply_text("✅ refreshed")
+    await register_commands(context.bot); await update.message.reply_text("✅ refreshed")
 
 async def aidiag(update, context):
     if update.effective_user.id != OWNER_ID: return
-    k = bool(OPENAI_API_KEY); await update.message.reply_text(f"AI_ENABLED={AI_ENABLED} key={'yes' if k else 'no'} model={OPENAI_CHAT_MODEL}")
+    k = bool(OPENAI_API_KEY)
+    await update.message.reply_text(f"AI_ENABLED={AI_ENABLED} key={'yes' if k else 'no'} model={OPENAI_CHAT_MODEL}\n{_ai_cache.stats()}")
 
 async def libdiag(update, context):
     if update.effective_user.id != OWNER_ID: return
@@ -1091,10 +2570,7 @@ async def libdiag(update, context):
 
 async def paylist(update, context):
     if update.effective_user.id != OWNER_ID: return
-    with _db_lock:
-        c = _db().cursor()
-        c.execute("SELECT * FROM payments ORDER BY created_at DESC LIMIT 20")
-        rows = [dict(x) for x in c.fetchall()]
+    rows = await payments_list_async(20)
     if not rows: await update.message.reply_text("no payments"); return
     txt = []
     for r in rows:
@@ -1102,25 +2578,147 @@ async def paylist(update, context):
         txt.append(f"{r['ref']}  user={r['user_id']}  {r['status']}  at={ts}")
     await update.message.reply_text("\n".join(txt))
 
+async def routestats(update, context):
+    if update.effective_user.id != OWNER_ID: return
+    await update.message.reply_text(router.report())
+
+async def ratestats(update, context):
+    if update.effective_user.id != OWNER_ID: return
+    await update.message.reply_text(rate_stats())
+
+async def pools_cmd(update, context):
+    if update.effective_user.id != OWNER_ID: return
+    await update.message.reply_text(pool_stats())
+
+# /profile [ثواني]: cProfile لثريد حلقة الأحداث + عيّنات مكدسات لكل الثريدات (DB/whois/...) ثم ملف نصي بأعلى النقاط الساخنة
+PROFILE_MAX_SECONDS = 120
+PROFILE_SAMPLE_INTERVAL = 0.01
+_profiling = False
+_IDLE_LEAVES = ("_worker (thread.py", "wait (threading.py", "get (queue.py")   # ثريدات تنتظر عملاً
+
+def _sample_stacks(stop: threading.Event, counts: dict):
+    me = threading.get_ident()
+    names = {}
+    while not stop.wait(PROFILE_SAMPLE_INTERVAL):
+        for tid, frame in sys._current_frames().items():
+            if tid == me: continue
+            if tid not in names:
+                names = {t.ident: t.name for t in threading.enumerate()}
+            stack = []
+            while frame is not None and len(stack) < 12:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack and stack[0].startswith(_IDLE_LEAVES): continue
+            key = (names.get(tid, str(tid)), " <- ".join(stack))
+            counts[key] = counts.get(key, 0) + 1
+
+async def profile_cmd(update, context):
+    global _profiling
+    if update.effective_user.id != OWNER_ID: return
+    if _profiling: await update.message.reply_text("⏳ profiling already running"); return
+    _profiling = True   # قبل أي await: طلبان متزامنان لا يمرّان معاً من الفحص
+    import cProfile, pstats
+    prof, stop, counts = cProfile.Profile(), threading.Event(), {}
+    sampler = threading.Thread(target=_sample_stacks, args=(stop, counts), name="profile-sampler", daemon=True)
+    try:
+        try: secs = min(max(float(context.args[0]), 1.0), PROFILE_MAX_SECONDS) if context.args else 10.0
+        except ValueError: secs = 10.0
+        await update.message.reply_text(f"🔬 profiling {secs:g}s…")
+        sampler.start(); prof.enable()
+        await asyncio.sleep(secs)
+    finally:
+        prof.disable(); stop.set()
+        if sampler.is_alive(): sampler.join()
+        _profiling = False
+    buf = io.StringIO()
+    buf.write(f"# cProfile (event loop thread, {secs:g}s) — top by tottime\n")
+    pstats.Stats(prof, stream=buf).sort_stats("tottime").print_stats(40)
+    buf.write(f"\n# stack samples (all threads, every {PROFILE_SAMPLE_INTERVAL*1000:g}ms) — top 40\n")
+    total = sum(counts.values()) or 1
+    for (thread, stack), n in sorted(counts.items(), key=lambda kv: -kv[1])[:40]:
+        buf.write(f"{n:6d} {n/total:6.1%}  [{thread}] {stack}\n")
+    data = buf.getvalue().encode()
+    await update.message.reply_document(InputFile(io.BytesIO(data), filename=f"profile-{int(time.time())}.txt"))
+
 async def restart_cmd(update, context):
     if update.effective_user.id == OWNER_ID:
-        await update.message.reply_text("🔄 restarting…"); os._exit(0)
+        await update.message.reply_text("🔄 restarting…")
+        await _ai_state.writer.flush(); await _user_journal.flush()   # os._exit يتجاوز post_shutdown
+        os._exit(0)
 
 async def on_error(update, context):
     log.error("error: %s", getattr(context, "error", "unknown"))
 
-# ------------- Runner -------------
-def main():
-    init_db()
-    run_health_server_threaded()  # سيرفر الصحة/الويبهوك على ثريد مستقل
+# ------------- metrics collectors -------------
+def _caches():
+    return {"user": _user_cache, "member": _member_cache, "member_state": _member_state, "whois": _whois_cache,
+            "dns": _dns.cache, "ai_mem": _ai_cache.mem, "ai_state": _ai_state}
+
+METRICS.collect("bot_cache_hits_total", "Cache hits", ("cache",),
+                lambda: [((n,), c.hits) for n, c in _caches().items()] + [(("ai_db",), _ai_cache.db_hits)], "counter")
+METRICS.collect("bot_cache_misses_total", "Cache misses", ("cache",),
+                lambda: [((n,), c.misses) for n, c in _caches().items()] + [(("ai_db",), _ai_cache.misses)], "counter")
+METRICS.collect("bot_cache_size", "Cache entries", ("cache",), lambda: [((n,), len(c)) for n, c in _caches().items()])
+METRICS.collect("bot_writebehind_pending", "Dirty keys waiting for the next flush", ("writer",),
+                lambda: [((w.name,), len(w)) for w in (_ai_state.writer, _user_journal)])
+METRICS.collect("bot_pool_active", "Running tasks per work pool", ("pool",), lambda: [((n,), p.active) for n, p in WORK_POOLS.items()])
+METRICS.collect("bot_pool_waiting", "Queued tasks per work pool", ("pool",), lambda: [((n,), p.waiting) for n, p in WORK_POOLS.items()])
+METRICS.collect("bot_pool_rejected_total", "Work turned away with a busy reply (pool queue full)", ("pool",),
+                lambda: [((n,), p.rejected) for n, p in WORK_POOLS.items()], "counter")
+METRICS.collect("bot_ratelimited_total", "Requests rejected by a token bucket", ("bucket",),
+                lambda: [((f"user:{c}",), b.limited) for c, b in _rl_user.items()] +
+                        [((f"upstream:{n}",), b.limited) for n, b in _rl_upstream.items()], "counter")
+METRICS.collect("bot_route_calls_total", "Callback route calls", ("route",), lambda: [((k,), v[0]) for k, v in router.stats.items()], "counter")
+METRICS.collect("bot_payinbox_total", "Payment inbox outcomes", ("result",), lambda: [((k,), v) for k, v in _pay_inbox.stats.items()], "counter")
+METRICS.collect("bot_webhook_total", "Telegram webhook ingest", ("result",),
+                lambda: [((k,), v) for k, v in webhook_stats.items() if k != "queue_max"], "counter")
+METRICS.collect("bot_update_backlog", "Accepted updates not yet fully processed", (), lambda: [((), update_backlog())])
+METRICS.collect("bot_payhook_total", "Payment webhook requests", ("result",), lambda: [((k,), v) for k, v in payhook_stats.items()], "counter")
+METRICS.collect("bot_member_checks_total", "Channel membership resolution", ("source",),
+                lambda: [((k,), v) for k, v in member_stats.items()], "counter")
+METRICS.collect("bot_singleflight_coalesced_total", "Calls that joined an in-flight request", ("flight",),
+                lambda: [(("member",), _member_flight.coalesced), (("paylink_auth",), _paylink_tokens._flight.coalesced)], "counter")
+METRICS.collect("bot_paylink_token_refresh_total", "Paylink auth token refresh attempts", ("result",),
+                lambda: [(("ok",), _paylink_tokens.refreshes), (("failed",), _paylink_tokens.failures)], "counter")
 
-    app = (
+# ------------- Runner -------------
+class TimedTelegramRequest(HTTPXRequest):
+    """HTTPXRequest لاستدعاءات Bot API (غير getUpdates) مع قياس الزمن والأخطاء تحت upstream=telegram."""
+    async def do_request(self, url, method, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            M_UPSTREAM_ERR.inc("telegram", type(e).__name__); raise
+        finally:
+            dt = time.perf_counter() - t0
+            M_UPSTREAM.observe(dt, "telegram"); trace_add(f"tg.{url.rsplit('/', 1)[-1]}", dt)
+        if code >= 400: M_UPSTREAM_ERR.inc("telegram", f"{code // 100}xx")
+        return code, payload
+
+async def _count_update(update: Update, context):
+    M_UPDATES.inc("callback_query" if update.callback_query else "message" if update.message
+                  else "chat_member" if update.chat_member else "other")
+
+def build_application(request=None) -> Application:
+    """request: BaseRequest بديل لاستدعاءات Bot API (مثلاً Bot API وهمي داخل العملية في bench/)."""
+    global _updates_queue
+    _updates_queue = UpdateQueue()
+    heavy = [n for n in POOL_LIMITS if n != "ui"]
+    if any(not POOL_QUEUES.get(n) for n in heavy) or sum(POOL_LIMITS[n] + POOL_QUEUES[n] for n in heavy) >= UPDATES_MAX_INFLIGHT:
+        log.warning("[pools] heavy pools can hold all %d update slots; menus may queue behind them", UPDATES_MAX_INFLIGHT)
+    builder = (
         Application.builder()
         .token(BOT_TOKEN)
-        .concurrent_updates(True)
+        .update_queue(_updates_queue)
+        .request(request or TimedTelegramRequest(connection_pool_size=256))
+        .concurrent_updates(UPDATES_MAX_INFLIGHT)
         .post_init(on_startup)   # ← الإصلاح هنا: إضافتها قبل build()
-        .build()
+        .post_shutdown(on_shutdown)
     )
+    if TELEGRAM_API_BASE:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE}/bot").base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+    app = builder.build()
 
     # handlers
     app.add_handler(CommandHandler("start", start))
@@ -1134,14 +2732,48 @@ def main():
     app.add_handler(CommandHandler("aidiag", aidiag))
     app.add_handler(CommandHandler("libdiag", libdiag))
     app.add_handler(CommandHandler("paylist", paylist))
+    app.add_handler(CommandHandler("routestats", routestats))
+    app.add_handler(CommandHandler("ratestats", ratestats))
+    app.add_handler(CommandHandler("pools", pools_cmd))
+    app.add_handler(CommandHandler("profile", profile_cmd))
     app.add_handler(CommandHandler("restart", restart_cmd))
 
     app.add_handler(CallbackQueryHandler(on_button))
+    app.add_handler(ChatMemberHandler(on_chat_member, ChatMemberHandler.CHAT_MEMBER))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, guard_messages))
+    for h in app.handlers[0]:
+        h.callback = timed_handler(h.callback.__name__, h.callback)
+    app.add_handler(TypeHandler(Update, _count_update), group=-1)
 
     app.add_error_handler(on_error)
+    return app
+
+async def run_webhook(app: Application):
+    """دورة حياة Application يدوياً: التحديثات تصل من سيرفر aiohttp (start_http_server) إلى update_queue."""
+    import signal
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError: pass
+    await app.initialize()
+    if app.post_init: await app.post_init(app)
+    await app.start()
+    try:
+        await stop.wait()
+    finally:
+        await app.stop()
+        if app.post_stop: await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown: await app.post_shutdown(app)
 
-    app.run_polling()
+def main():
+    init_db()  # الترحيلات مرة واحدة عند الإقلاع — لا DDL في مسار التحديثات
+    app = build_application()
+    if TG_WEBHOOK:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)  # chat_member لا يصل افتراضياً
 
 if __name__ == "__main__":
     main()